@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import textwrap
+import time
+import tracemalloc
+
+import numpy as np
+
+"""
+Synthetic benchmarks of the mutation, encoding, I/O and analysis hot paths
+
+A random genome (fasta + fai) and a mutation bed are generated at the
+requested scale (--genome-size from 1 Mb to 1 Gb, --mutations from 10 to
+10^6), then each case is timed (median of --repeat runs) and its peak python
+memory recorded with tracemalloc:
+
+  - mutate.Mutator.mutate, check and get_SeqRecords
+  - mutate.replace_substring
+  - selene Genome.sequence_to_encoding (skipped if selene is not installed)
+  - process_sequence.dump_target_matrix writes and orcaio.read_matrix reads
+  - numutils.observed_over_expected and adaptive_coarsegrain
+
+Everything runs on CPU: the Orca model is replaced by StubOrca, which returns
+random matrices with the structure of orca_predict.genomepredict outputs.
+
+Results are written as json; with --baseline, every case slower than the
+baseline by more than --tolerance is reported as a regression and the exit
+status is 1.
+"""
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO, "scripts"))
+sys.path.insert(0, os.path.join(REPO, "notebooks"))
+
+NUCLEOTIDES = np.frombuffer(b"ACGT", dtype=np.uint8)
+OPERATIONS = ["shuffle", "inversion", "mask"]
+
+MUTATION_CASES = ["Mutator.mutate", "Mutator.check", "Mutator.get_SeqRecords",
+                  "replace_substring"]
+ENCODING_CASES = ["Genome.sequence_to_encoding"]
+IO_CASES = ["dump_target_matrix.write", "dump_target_matrix.read"]
+ANALYSIS_CASES = ["observed_over_expected", "adaptive_coarsegrain"]
+
+
+def eprint(*args, **kwargs):
+    print(*args,  file=sys.stderr, **kwargs)
+
+
+class StubOrca():
+    """
+    CPU stand-in for the Orca multiscale model
+
+    genomepredict returns a dictionnary with the keys used by
+    dump_target_matrix: predictions and normmats (2 models x 6 resolutions
+    of nbins x nbins matrices), start_coords and end_coords
+    """
+    def __init__(self, nbins=250, seed=0):
+        self.nbins = nbins
+        self.rng = np.random.default_rng(seed)
+
+    def _matrix(self):
+        distance = np.abs(np.subtract.outer(np.arange(self.nbins), np.arange(self.nbins)))
+        noise = self.rng.normal(scale=0.1, size=(self.nbins, self.nbins))
+        return -np.log1p(distance) + (noise + noise.T) / 2
+
+    def genomepredict(self, mpos=16_000_000, chromlen=32_000_000):
+        widths = [32_000_000 >> level for level in range(6)]
+        starts = [max(0, min(mpos - width // 2, chromlen - width)) for width in widths]
+        return {
+            "predictions": [[self._matrix() for _ in widths] for _ in range(2)],
+            "normmats": [[self._matrix() for _ in widths] for _ in range(2)],
+            "start_coords": starts,
+            "end_coords": [start + width for start, width in zip(starts, widths)],
+        }
+
+
+def make_genome(directory, size, chromosomes=1, seed=0, line_width=60, chunk_lines=1_000_000):
+    """
+    Writes a random genome of size bp split into chromosomes, with its fai index
+
+    The sequence is drawn and written by chunks of chunk_lines lines, as uint8,
+    so that the memory does not grow with the genome size
+    """
+    rng = np.random.default_rng(seed)
+    fasta = os.path.join(directory, "genome.fa")
+    chromlen = size // chromosomes
+    with open(fasta, "wb") as fout, open(fasta + ".fai", "w") as fai:
+        for num in range(1, chromosomes + 1):
+            header = (">%d\n" % num).encode()
+            fout.write(header)
+            offset = fout.tell()
+            for lo in range(0, chromlen, chunk_lines * line_width):
+                length = min(chunk_lines * line_width, chromlen - lo)
+                sequence = NUCLEOTIDES[rng.integers(0, 4, size=length, dtype=np.uint8)]
+                nlines = -(-length // line_width)
+                padded = np.full(nlines * (line_width + 1), ord("\n"), dtype=np.uint8)
+                lines = padded.reshape(nlines, line_width + 1)
+                full = length // line_width
+                lines[:full, :line_width] = sequence[:full * line_width].reshape(full, line_width)
+                rest = length - full * line_width
+                if rest:
+                    # only the last chunk of a chromosome ends with a partial line
+                    lines[full, :rest] = sequence[full * line_width:]
+                    padded = padded[:full * (line_width + 1) + rest + 1]
+                fout.write(padded.tobytes())
+            fai.write("%d\t%d\t%d\t%d\t%d\n" % (num, chromlen, offset, line_width,
+                                                line_width + 1))
+    return fasta, {str(num): chromlen for num in range(1, chromosomes + 1)}
+
+
+def make_mutations(directory, chromsizes, count, min_len=100, max_len=1000, seed=0):
+    """Writes count non overlapping random mutations in the 7 columns format"""
+    rng = np.random.default_rng(seed)
+    bedfile = os.path.join(directory, "mutations.bed")
+    chroms = list(chromsizes)
+    per_chrom = np.bincount(rng.integers(0, len(chroms), size=count), minlength=len(chroms))
+    num = 0
+    with open(bedfile, "w") as fout:
+        for chrom, n in zip(chroms, per_chrom):
+            if n == 0:
+                continue
+            slot = chromsizes[chrom] // n
+            if slot < min_len:
+                raise ValueError("too many mutations for chromosome %s" % chrom)
+            lengths = rng.integers(min_len, min(max_len, slot) + 1, size=n)
+            starts = np.arange(n) * slot + rng.integers(0, slot - lengths + 1)
+            ops = rng.integers(0, len(OPERATIONS), size=n)
+            for start, length, op in zip(starts.tolist(), lengths.tolist(), ops.tolist()):
+                num += 1
+                fout.write("%s\t%d\t%d\t.\t%s%d\t+\t%s\n" % (chrom, start, start + length,
+                                                             OPERATIONS[op], num, OPERATIONS[op]))
+    return bedfile
+
+
+def measure(func, repeat=3):
+    """
+    Returns the median time (s) of func() and its peak python memory (MB)
+
+    The timed runs are not traced; the peak memory is measured in one more
+    run under tracemalloc, whose overhead would otherwise dominate the times
+    """
+    times = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - begin)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    times.sort()
+    return {"seconds": times[len(times) // 2], "peak_mb": peak / 2**20}
+
+
+def mutation_cases(fasta, bedfile, chromsizes):
+    from pysam import FastaFile
+    from mutate import Mutator, read_mutations, replace_substring
+
+    mutations = read_mutations(bedfile)
+    maximum_cached = len(chromsizes) + 1
+
+    def mutator():
+        return Mutator(FastaFile(fasta), mutations, maximumCached=maximum_cached)
+
+    def mutate():
+        mutator().mutate()
+
+    mutated = mutator()
+    mutated.mutate()
+
+    def check():
+        for chrom in chromsizes:
+            mutated.check(chrom)
+
+    def records():
+        mutated.get_SeqRecords()
+
+    chrom = next(iter(chromsizes))
+    sequence = FastaFile(fasta).fetch(chrom)
+    middle = len(sequence) // 2
+    insert = "N" * 1000
+
+    def replace():
+        replace_substring(sequence, insert, middle, middle + len(insert))
+
+    return {"Mutator.mutate": mutate, "Mutator.check": check,
+            "Mutator.get_SeqRecords": records, "replace_substring": replace}, sequence
+
+
+def encoding_cases(sequence, length=1_000_000):
+    try:
+        from selene_sdk.sequences import Genome
+    except ImportError:
+        return {}
+    subsequence = sequence[:length]
+
+    def encode():
+        Genome.sequence_to_encoding(subsequence)
+
+    return {"Genome.sequence_to_encoding": encode}
+
+
+def io_cases(directory, matrices):
+    from process_sequence import dump_target_matrix
+    from orcaio import RESOLUTIONS, matrix_path, read_matrix
+
+    model = StubOrca()
+    outputs = [model.genomepredict() for _ in range(matrices)]
+    prefixes = [os.path.join(directory, "stub%d" % num) for num in range(matrices)]
+
+    def write():
+        for output, prefix in zip(outputs, prefixes):
+            dump_target_matrix(output, prefix, 16_000_000, 16_000_000, "None", "1", 32_000_000)
+
+    write()
+
+    def read():
+        for prefix in prefixes:
+            for resol in RESOLUTIONS:
+                read_matrix(matrix_path(prefix, resol, "predictions"))
+                read_matrix(matrix_path(prefix, resol, "normmats"))
+
+    return {"dump_target_matrix.write": write, "dump_target_matrix.read": read}
+
+
+def analysis_cases(size, seed=0):
+    from numutils import observed_over_expected, adaptive_coarsegrain
+
+    rng = np.random.default_rng(seed)
+    distance = np.abs(np.subtract.outer(np.arange(size), np.arange(size)))
+    counts = rng.poisson(50 / (1 + distance)).astype(float)
+    counts = counts + counts.T
+    balanced = counts / counts.sum(axis=0).mean()
+    mask = counts.sum(axis=0) > 0
+
+    def oe():
+        observed_over_expected(balanced, mask)
+
+    def coarsegrain():
+        adaptive_coarsegrain(balanced, counts)
+
+    return {"observed_over_expected": oe, "adaptive_coarsegrain": coarsegrain}
+
+
+def _selected(cases, names):
+    return not cases or any(name in cases for name in names)
+
+
+def run(genome_size, mutations, chromosomes=1, matrices=2, matrix_size=250, repeat=3,
+        seed=0, cases=None):
+    """
+    Generates the synthetic data and runs the benchmarks
+
+    Returns
+    -------
+    dict
+        {"config": ..., "results": {case: {"seconds": ..., "peak_mb": ...}}}
+    """
+    random.seed(seed)
+    config = {"genome_size": genome_size, "mutations": mutations, "chromosomes": chromosomes,
+              "matrices": matrices, "matrix_size": matrix_size, "repeat": repeat,
+              "seed": seed, "python": platform.python_version(),
+              "numpy": np.__version__, "machine": platform.machine()}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        begin = time.perf_counter()
+        fasta, chromsizes = make_genome(tmpdir, genome_size, chromosomes, seed)
+        bedfile = make_mutations(tmpdir, chromsizes, mutations, seed=seed)
+        eprint("Synthetic data generated in %.1fs" % (time.perf_counter() - begin))
+
+        funcs = {}
+        if _selected(cases, MUTATION_CASES + ENCODING_CASES):
+            mutation_funcs, sequence = mutation_cases(fasta, bedfile, chromsizes)
+            funcs.update(mutation_funcs)
+            funcs.update(encoding_cases(sequence))
+        if _selected(cases, IO_CASES):
+            funcs.update(io_cases(tmpdir, matrices))
+        if _selected(cases, ANALYSIS_CASES):
+            funcs.update(analysis_cases(matrix_size, seed))
+        for name, func in funcs.items():
+            if cases and name not in cases:
+                continue
+            results[name] = measure(func, repeat)
+            eprint("%-28s %10.4fs %10.1fMB" % (name, results[name]["seconds"],
+                                               results[name]["peak_mb"]))
+    return {"config": config, "results": results}
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Returns the cases slower than the baseline by more than tolerance"""
+    regressions = {}
+    for name, current in results["results"].items():
+        previous = baseline["results"].get(name)
+        if previous is None or previous["seconds"] == 0:
+            continue
+        ratio = current["seconds"] / previous["seconds"]
+        if ratio > 1 + tolerance:
+            regressions[name] = {"baseline_s": previous["seconds"],
+                                 "current_s": current["seconds"], "ratio": ratio}
+    if baseline.get("config", {}).get("genome_size") != results["config"]["genome_size"]:
+        eprint("Warning: the baseline was run with a different configuration")
+    return regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=textwrap.dedent('''\
+                                     Benchmark the mutation, encoding, I/O and analysis hot paths on synthetic data
+                                     '''))
+    parser.add_argument('--genome-size', type=float, default=1e6,
+                        required=False, help='synthetic genome size in bp (default: 1e6)')
+    parser.add_argument('--mutations', type=float, default=100,
+                        required=False, help='number of mutations (default: 100)')
+    parser.add_argument('--chromosomes', type=int, default=1,
+                        required=False, help='number of chromosomes (default: 1)')
+    parser.add_argument('--matrices', type=int, default=2,
+                        required=False, help='number of stub predictions written and read (default: 2)')
+    parser.add_argument('--matrix-size', type=int, default=250,
+                        required=False, help='matrix size for the analysis cases (default: 250)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        required=False, help='runs per case, the median is reported (default: 3)')
+    parser.add_argument('--cases', nargs='+',
+                        choices=MUTATION_CASES + ENCODING_CASES + IO_CASES + ANALYSIS_CASES,
+                        required=False, help='run only these cases')
+    parser.add_argument('--output',
+                        required=True, help='the json output')
+    parser.add_argument('--baseline',
+                        required=False, help='a previous json output to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        required=False, help='allowed slowdown before a regression (default: 0.2)')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    results = run(int(args.genome_size), int(args.mutations), args.chromosomes, args.matrices,
+                  args.matrix_size, args.repeat, cases=args.cases)
+    status = 0
+    if args.baseline:
+        with open(args.baseline, "r") as fin:
+            baseline = json.load(fin)
+        results["regressions"] = compare(results, baseline, args.tolerance)
+        for name, regression in results["regressions"].items():
+            eprint("Regression %s: %.4fs -> %.4fs (x%.2f)" % (name, regression["baseline_s"],
+                                                            regression["current_s"],
+                                                            regression["ratio"]))
+        status = 1 if results["regressions"] else 0
+    with open(args.output, "w") as fout:
+        json.dump(results, fout, indent=2)
+    sys.exit(status)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+
+"""
+Startup time of the command line scripts and notebook helpers
+
+Each command is run several times in a fresh interpreter and the median wall
+time is reported. With --baseline REV, the same commands are also run on the
+files of git revision REV (extracted in a temporary directory), which shows
+the gain of the lazy imports on short-lived invocations (--help, argument
+errors, workers importing colormaps).
+
+Commands whose imports are missing in the current environment are reported
+as failed (the exit status is recorded) but still timed.
+"""
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FILES = ["scripts/mutate.py", "scripts/intervals.py", "scripts/process_sequence.py",
+         "scripts/process_sequence_1Mb.py", "scripts/orcaio.py", "scripts/deltastore.py",
+         "notebooks/colormaps.py", "notebooks/numutils.py"]
+
+# (name, working directory relative to the repository, arguments)
+COMMANDS = [
+    ("python", ".", ["-c", "pass"]),
+    ("process_sequence --help", "scripts", ["process_sequence.py", "--help"]),
+    ("process_sequence_1Mb --help", "scripts", ["process_sequence_1Mb.py", "--help"]),
+    ("process_sequence_1Mb bad arguments", "scripts", ["process_sequence_1Mb.py", "--start", "x"]),
+    ("mutate --help", "scripts", ["mutate.py", "--help"]),
+    ("import colormaps", "notebooks", ["-c", "import colormaps"]),
+    ("colormaps.hnh_cmap_ext5", "notebooks", ["-c", "import colormaps; colormaps.hnh_cmap_ext5"]),
+]
+
+
+def eprint(*args, **kwargs):
+    print(*args,  file=sys.stderr, **kwargs)
+
+
+def time_command(root, workdir, arguments, repeat):
+    """Returns the median wall time (s) and the last exit status of a command"""
+    times = []
+    status = 0
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        process = subprocess.run([sys.executable] + arguments, cwd=os.path.join(root, workdir),
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - begin)
+        status = process.returncode
+    times.sort()
+    return times[len(times) // 2], status
+
+
+def extract_revision(revision, directory):
+    """Writes the benchmarked files of a git revision in directory"""
+    for path in FILES:
+        process = subprocess.run(["git", "show", "%s:%s" % (revision, path)], cwd=REPO,
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if process.returncode != 0:
+            continue
+        output = os.path.join(directory, path)
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, "wb") as fout:
+            fout.write(process.stdout)
+
+
+def main(repeat=5, baseline=None, output=None):
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if baseline is not None:
+            extract_revision(baseline, tmpdir)
+        for name, workdir, arguments in COMMANDS:
+            current, status = time_command(REPO, workdir, arguments, repeat)
+            result = {"command": name, "current_s": current, "current_status": status}
+            if baseline is not None:
+                previous, status = time_command(tmpdir, workdir, arguments, repeat)
+                result.update({"baseline_s": previous, "baseline_status": status,
+                               "speedup": previous / current})
+            results.append(result)
+
+    header = "%-36s %10s %6s" % ("command", "current", "status")
+    if baseline is not None:
+        header += " %10s %6s %8s" % ("baseline", "status", "speedup")
+    print(header)
+    for result in results:
+        line = "%-36s %8.0fms %6d" % (result["command"], 1000 * result["current_s"],
+                                       result["current_status"])
+        if baseline is not None:
+            line += " %8.0fms %6d %7.1fx" % (1000 * result["baseline_s"], result["baseline_status"],
+                                             result["speedup"])
+        print(line)
+    if output is not None:
+        with open(output, "w") as fout:
+            json.dump(results, fout, indent=2)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=textwrap.dedent('''\
+                                     Measure the startup time of the scripts and notebook helpers
+                                     '''))
+    parser.add_argument('--repeat', type=int, default=5,
+                        required=False, help='runs per command, the median is reported (default: 5)')
+    parser.add_argument('--baseline',
+                        required=False, help='git revision to compare with, for example HEAD~1')
+    parser.add_argument('--output',
+                        required=False, help='optional json output')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    main(args.repeat, args.baseline, args.output)
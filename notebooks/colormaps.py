@@ -1,19 +1,18 @@
 """
 Common and custom colormaps for plotting.
+
+The colormaps are built on first access and cached, so that importing this
+module does not import matplotlib nor build every map:
+
+>>> import colormaps
+>>> cmap = colormaps.hnh_cmap_ext5   # built here
+>>> cmap = colormaps.get("hnh_cmap_ext5")   # cached
 """
 import copy
-from matplotlib.colors import colorConverter
-import matplotlib
-import matplotlib as mpl
-import matplotlib.cm
-import numpy as np
 
+import numpy as np
 
-viridis_cmap = copy.copy(matplotlib.cm.get_cmap("viridis"))
-viridis_cmap.set_bad(color="#AAAAAA")
-
-ylorrd_cmap = copy.copy(matplotlib.cm.get_cmap("YlOrRd"))
-ylorrd_cmap.set_bad(color="#AAAAAA")
+BAD_COLOR = "#AAAAAA"
 
 cdict = {
     "red": [
@@ -37,79 +36,177 @@ cdict = {
 }
 
 
-fall_cmap = matplotlib.colors.LinearSegmentedColormap("fall", cdict, 256)
+def _viridis_cmap():
+    import matplotlib.cm
+    viridis_cmap = copy.copy(matplotlib.cm.get_cmap("viridis"))
+    viridis_cmap.set_bad(color=BAD_COLOR)
+    return viridis_cmap
 
-newcmap2 = mpl.colors.LinearSegmentedColormap.from_list(
-    "newcmap2",
-    [
-        colorConverter.to_rgba(c)
-        for c in ["#fff1d7", "#ffda9d", "#ffb362", "#ff8241", "#ff2b29", "#d60026", "#880028",]
-    ],
-    256,
-)
-newcmap2._init()
-newcmap2.set_bad(color="#AAAAAA")
-
-
-hnh_cmap = mpl.colors.LinearSegmentedColormap.from_list(
-    "hnhcmap",
-    0.5 * newcmap2(np.linspace(0.0, 1, 256)) + 0.5 * ylorrd_cmap(np.linspace(0.0, 1, 256)),
-    256,
-)
-hnh_cmap.set_bad(color="#AAAAAA")
-
-hnh_cmap_ext = mpl.colors.LinearSegmentedColormap.from_list(
-    "hnh_cmap_ext",
-    np.vstack(
-        [
-            np.vstack(
-                [
-                    np.ones(34),
-                    np.concatenate(
-                        [np.arange(0.97254902, 1, 0.97254902 - 0.97038062), np.ones(21)]
-                    ),
-                    np.arange(0.82156863, 1, 0.82156863 - 0.81618608),
-                    np.ones(34),
-                ]
-            ).T[::-1, :][:-1, :],
-            hnh_cmap(np.linspace(0.0, 1, 256)),
-        ]
-    ),
-)
-hnh_cmap_ext.set_bad(color="#AAAAAA")
-
-hnh_cmap_ext3 = mpl.colors.LinearSegmentedColormap.from_list(
-    "hnh_cmap_ext3",
-    np.vstack(
+
+def _ylorrd_cmap():
+    import matplotlib.cm
+    ylorrd_cmap = copy.copy(matplotlib.cm.get_cmap("YlOrRd"))
+    ylorrd_cmap.set_bad(color=BAD_COLOR)
+    return ylorrd_cmap
+
+
+def _fall_cmap():
+    import matplotlib.colors
+    return matplotlib.colors.LinearSegmentedColormap("fall", cdict, 256)
+
+
+def _newcmap2():
+    import matplotlib as mpl
+    from matplotlib.colors import colorConverter
+    newcmap2 = mpl.colors.LinearSegmentedColormap.from_list(
+        "newcmap2",
         [
-            hnh_cmap_ext(np.linspace(0.0, 1, 256)),
-            np.vstack(
-                [
-                    np.arange(0.51764706, 0.15294118, 0.51764706 - 0.52594939),
-                    np.zeros(44),
-                    np.ones(44) * 0.15294118,
-                    np.ones(44),
-                ]
-            ).T[1:, :],
-        ]
-    ),
-)
-hnh_cmap_ext3.set_bad(color="#AAAAAA")
-
-hnh_cmap_ext4 = mpl.colors.LinearSegmentedColormap.from_list(
-    "hnh_cmap_ext4", hnh_cmap_ext3(np.linspace(0.0, 1, 512))[16:, :]
-)
-hnh_cmap_ext4.set_bad(color="#AAAAAA")
-
-hnh_cmap_ext5 = mpl.colors.LinearSegmentedColormap.from_list(
-    "hnh_cmap_ext5", hnh_cmap_ext3(np.linspace(0.0, 1, 512))[32:, :]
-)
-hnh_cmap_ext5.set_bad(color="#AAAAAA")
-
-color1 = colorConverter.to_rgba("white")
-color2 = colorConverter.to_rgba("black")
-
-bwcmap = mpl.colors.LinearSegmentedColormap.from_list("bwcmap", [color1, color2], 256)
-bwcmap._init()
-alphas = np.linspace(0, 0.2, bwcmap.N + 3)
-bwcmap._lut[:, -1] = alphas
+            colorConverter.to_rgba(c)
+            for c in ["#fff1d7", "#ffda9d", "#ffb362", "#ff8241", "#ff2b29", "#d60026", "#880028",]
+        ],
+        256,
+    )
+    newcmap2._init()
+    newcmap2.set_bad(color=BAD_COLOR)
+    return newcmap2
+
+
+def _hnh_cmap():
+    import matplotlib as mpl
+    hnh_cmap = mpl.colors.LinearSegmentedColormap.from_list(
+        "hnhcmap",
+        0.5 * get("newcmap2")(np.linspace(0.0, 1, 256)) +
+        0.5 * get("ylorrd_cmap")(np.linspace(0.0, 1, 256)),
+        256,
+    )
+    hnh_cmap.set_bad(color=BAD_COLOR)
+    return hnh_cmap
+
+
+def _hnh_cmap_ext():
+    import matplotlib as mpl
+    hnh_cmap_ext = mpl.colors.LinearSegmentedColormap.from_list(
+        "hnh_cmap_ext",
+        np.vstack(
+            [
+                np.vstack(
+                    [
+                        np.ones(34),
+                        np.concatenate(
+                            [np.arange(0.97254902, 1, 0.97254902 - 0.97038062), np.ones(21)]
+                        ),
+                        np.arange(0.82156863, 1, 0.82156863 - 0.81618608),
+                        np.ones(34),
+                    ]
+                ).T[::-1, :][:-1, :],
+                get("hnh_cmap")(np.linspace(0.0, 1, 256)),
+            ]
+        ),
+    )
+    hnh_cmap_ext.set_bad(color=BAD_COLOR)
+    return hnh_cmap_ext
+
+
+def _hnh_cmap_ext3():
+    import matplotlib as mpl
+    hnh_cmap_ext3 = mpl.colors.LinearSegmentedColormap.from_list(
+        "hnh_cmap_ext3",
+        np.vstack(
+            [
+                get("hnh_cmap_ext")(np.linspace(0.0, 1, 256)),
+                np.vstack(
+                    [
+                        np.arange(0.51764706, 0.15294118, 0.51764706 - 0.52594939),
+                        np.zeros(44),
+                        np.ones(44) * 0.15294118,
+                        np.ones(44),
+                    ]
+                ).T[1:, :],
+            ]
+        ),
+    )
+    hnh_cmap_ext3.set_bad(color=BAD_COLOR)
+    return hnh_cmap_ext3
+
+
+def _hnh_cmap_ext4():
+    import matplotlib as mpl
+    hnh_cmap_ext4 = mpl.colors.LinearSegmentedColormap.from_list(
+        "hnh_cmap_ext4", get("hnh_cmap_ext3")(np.linspace(0.0, 1, 512))[16:, :]
+    )
+    hnh_cmap_ext4.set_bad(color=BAD_COLOR)
+    return hnh_cmap_ext4
+
+
+def _hnh_cmap_ext5():
+    import matplotlib as mpl
+    hnh_cmap_ext5 = mpl.colors.LinearSegmentedColormap.from_list(
+        "hnh_cmap_ext5", get("hnh_cmap_ext3")(np.linspace(0.0, 1, 512))[32:, :]
+    )
+    hnh_cmap_ext5.set_bad(color=BAD_COLOR)
+    return hnh_cmap_ext5
+
+
+def _bwcmap():
+    import matplotlib as mpl
+    from matplotlib.colors import colorConverter
+    color1 = colorConverter.to_rgba("white")
+    color2 = colorConverter.to_rgba("black")
+
+    bwcmap = mpl.colors.LinearSegmentedColormap.from_list("bwcmap", [color1, color2], 256)
+    bwcmap._init()
+    alphas = np.linspace(0, 0.2, bwcmap.N + 3)
+    bwcmap._lut[:, -1] = alphas
+    return bwcmap
+
+
+_BUILDERS = {
+    "viridis_cmap": _viridis_cmap,
+    "ylorrd_cmap": _ylorrd_cmap,
+    "fall_cmap": _fall_cmap,
+    "newcmap2": _newcmap2,
+    "hnh_cmap": _hnh_cmap,
+    "hnh_cmap_ext": _hnh_cmap_ext,
+    "hnh_cmap_ext3": _hnh_cmap_ext3,
+    "hnh_cmap_ext4": _hnh_cmap_ext4,
+    "hnh_cmap_ext5": _hnh_cmap_ext5,
+    "bwcmap": _bwcmap,
+}
+
+_CMAPS = {}
+_LUTS = {}
+
+
+def names():
+    """Returns the names of the available colormaps"""
+    return list(_BUILDERS)
+
+
+def get(name):
+    """Returns the colormap name, building it on first access"""
+    if name not in _CMAPS:
+        if name not in _BUILDERS:
+            raise KeyError("%s is not a known colormap" % name)
+        _CMAPS[name] = _BUILDERS[name]()
+    return _CMAPS[name]
+
+
+def lut(name, size=256):
+    """
+    Returns the colormap name as a (size, 4) uint8 RGBA lookup table, for
+    rendering without matplotlib (see thumbnails.py)
+    """
+    if (name, size) not in _LUTS:
+        rgba = get(name)(np.linspace(0.0, 1, size))
+        _LUTS[(name, size)] = np.rint(np.clip(rgba, 0, 1) * 255).astype(np.uint8)
+    return _LUTS[(name, size)]
+
+
+def __getattr__(name):
+    if name in _BUILDERS:
+        return get(name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + names())
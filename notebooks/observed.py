@@ -0,0 +1,208 @@
+"""
+Observed (micro-C / Hi-C) matrices on the multi-resolution grid of Orca.
+
+Replaces getRealMatrix of the ObservedExpected notebooks:
+  - the cooler handles of the mcool resolutions are opened once and kept
+  - the raw matrix is fetched once and balanced with the bin weights, instead
+    of two fetches (balance=True and balance=False)
+  - with fetch_resolution, the outer window of a set of nested Orca windows
+    (32/16/8/4/2/1 Mb) is fetched once at that resolution and the coarser
+    windows are derived by aggregation; windows finer than fetch_resolution
+    are fetched at their own resolution
+  - the balanced and adaptively coarsegrained matrices are cached on disk,
+    keyed by (file, resolution, region)
+
+>>> provider = ObservedProvider("4DNFI9GMP2J8.rebinned.mcool", cache_dir="observed_cache",
+...                             fetch_resolution=16_000)
+>>> mat, mat_cg = provider.region(128_000, "chr9", 94_900_000, 126_900_000)
+>>> matrices = provider.for_headers(headers)   # headers of dump_target_matrix outputs
+"""
+import hashlib
+import os
+
+import numpy as np
+
+from numutils import adaptive_coarsegrain
+
+
+def aggregate(raw, balanced, factor):
+    """
+    Sums factor x factor blocks of fine matrices
+
+    Raw counts are aggregated exactly. Balanced rows sum to ~1 at every
+    resolution, so the balanced block sums are divided by factor to keep
+    that property (an approximation of the balancing at the coarse
+    resolution). A coarse pixel is NaN only if all its fine pixels are.
+    """
+    if factor == 1:
+        return raw, balanced
+    n = raw.shape[0] // factor
+    raw = raw[:n * factor, :n * factor].reshape(n, factor, n, factor)
+    balanced = balanced[:n * factor, :n * factor].reshape(n, factor, n, factor)
+    valid = np.isfinite(balanced).any(axis=(1, 3))
+    coarse = np.nansum(balanced, axis=(1, 3)) / factor
+    coarse[~valid] = np.nan
+    return raw.sum(axis=(1, 3)), coarse
+
+
+class ObservedProvider():
+    """
+    Cached extraction of observed matrices from a multi-resolution cooler
+
+    Parameters
+    ----------
+    mcool: str
+        the .mcool file
+    cache_dir: str
+        directory of the on-disk cache (no disk cache if None)
+    fetch_resolution: int
+        resolution at which nested windows are fetched once and aggregated
+        (default: None, every window is fetched at its own resolution)
+    cutoff: float
+        the adaptive_coarsegrain cutoff
+    """
+    def __init__(self, mcool, cache_dir=None, fetch_resolution=None, cutoff=5):
+        self.mcool = os.path.abspath(mcool)
+        self.cache_dir = cache_dir
+        self.fetch_resolution = fetch_resolution
+        self.cutoff = cutoff
+        self.coolers = {}
+        self.blocks = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def cooler(self, resolution):
+        """Returns the (kept open) cooler handle of a resolution"""
+        if resolution not in self.coolers:
+            import cooler
+            self.coolers[resolution] = cooler.Cooler("%s::resolutions/%d" % (self.mcool,
+                                                                              resolution))
+        return self.coolers[resolution]
+
+    def fetch(self, resolution, chrom, start, end):
+        """
+        Fetches the raw and balanced matrices of a region with a single query
+
+        Returns
+        -------
+        tuple
+            (raw, balanced, first bin start)
+        """
+        clr = self.cooler(resolution)
+        end = min(end, clr.chromsizes[chrom])
+        region = (chrom, start, end)
+        raw = clr.matrix(balance=False).fetch(region).astype(np.float64)
+        weights = clr.bins().fetch(region)["weight"].to_numpy(dtype=np.float64)
+        balanced = raw * weights[:, None] * weights[None, :]
+        return raw, balanced, (start // resolution) * resolution
+
+    def _block(self, resolution, chrom, start, end):
+        """Returns an in-memory fetched block containing the region, fetching it if needed"""
+        for (res, block_chrom, block_start, block_end), block in self.blocks.items():
+            if (res == resolution and block_chrom == chrom and block_start <= start and
+                    end <= block_end):
+                return block
+        block = self.fetch(resolution, chrom, start, end)
+        self.blocks[(resolution, chrom, start, end)] = block
+        return block
+
+    def clear(self):
+        """Forgets the in-memory blocks"""
+        self.blocks = {}
+
+    def _cache_path(self, resolution, chrom, start, end):
+        key = "%s:%d:%d:%s:%d:%d:%s:%s" % (self.mcool, os.path.getmtime(self.mcool), resolution,
+                                          chrom, start, end, self.fetch_resolution, self.cutoff)
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        name = "%s_%d_%d_%d_%s.npz" % (chrom, resolution, start, end, digest)
+        return os.path.join(self.cache_dir, name)
+
+    def _compute(self, resolution, chrom, start, end, extent=None):
+        fetch_resolution = self.fetch_resolution
+        # aggregation reproduces the bins of a direct fetch only for windows on
+        # the resolution grid and inside the chromosome (cooler clamps the
+        # last bins at the chromosome end)
+        aligned = (fetch_resolution is not None and resolution >= fetch_resolution and
+                   resolution % fetch_resolution == 0 and start % resolution == 0 and
+                   end % resolution == 0 and 0 <= start and
+                   end <= self.cooler(fetch_resolution).chromsizes[chrom])
+        if not aligned:
+            raw, balanced, _ = self._block(resolution, chrom, start, end)
+            return balanced, raw
+        block_start, block_end = extent if extent is not None else (start, end)
+        raw, balanced, first = self._block(fetch_resolution, chrom, block_start, block_end)
+        factor = resolution // fetch_resolution
+        offset = (start - first) // fetch_resolution
+        size = -(-(end - start) // resolution) * factor
+        raw, balanced = aggregate(raw[offset:offset + size, offset:offset + size],
+                                  balanced[offset:offset + size, offset:offset + size], factor)
+        return balanced, raw
+
+    def region(self, resolution, chrom, start, end, extent=None):
+        """
+        Returns the balanced and the adaptively coarsegrained matrices of a region,
+        as getRealMatrix
+
+        Parameters
+        ----------
+        resolution: int
+            the resolution of the returned matrices
+        chrom, start, end: str, int, int
+            the region
+        extent: tuple
+            optional (start, end) of an enclosing region to fetch at
+            fetch_resolution, so that the nested windows share one fetch
+
+        The matrices are aggregated from the fetch_resolution block only when
+        start and end are multiples of resolution and the window lies inside
+        the chromosome; other windows are fetched directly at resolution, so
+        that the returned bins do not depend on fetch_resolution.
+        """
+        cache = None
+        if self.cache_dir is not None:
+            cache = self._cache_path(resolution, chrom, start, end)
+            if os.path.exists(cache):
+                with np.load(cache) as data:
+                    return data["mat"], data["mat_cg"]
+        mat, raw = self._compute(resolution, chrom, start, end, extent)
+        mat_cg = adaptive_coarsegrain(mat, raw, cutoff=self.cutoff)
+        if cache is not None:
+            np.savez(cache, mat=mat, mat_cg=mat_cg)
+        return mat, mat_cg
+
+    def for_headers(self, headers):
+        """
+        Returns the (mat, mat_cg) observed matrices of a batch of prediction headers
+
+        Parameters
+        ----------
+        headers: list
+            dictionnaries with chrom, start, end, nbins, mpos and wpos, as parsed
+            from the dump_target_matrix headers (orcaio.parse_header) or the
+            catalog; headers without mpos or wpos are fetched on their own
+        Returns
+        -------
+        list
+            (mat, mat_cg) in the order of headers
+        """
+        results = [None] * len(headers)
+        # the windows of one prediction (same chrom, mpos and wpos) are nested:
+        # the outer window of each prediction is fetched once for all of them
+        groups = {}
+        for i, header in enumerate(headers):
+            key = (header["chrom"], header.get("mpos"), header.get("wpos"))
+            if key[1] is None or key[2] is None:
+                key = (header["chrom"], i)
+            groups.setdefault(key, []).append(i)
+        for (chrom, *_), indices in groups.items():
+            outer = max(indices, key=lambda i: headers[i]["end"] - headers[i]["start"])
+            extent = (headers[outer]["start"], headers[outer]["end"])
+            for i in indices:
+                header = headers[i]
+                start, end = header["start"], header["end"]
+                resolution = (end - start) // header.get("nbins", 250)
+                nested = extent[0] <= start and end <= extent[1]
+                results[i] = self.region(resolution, chrom, start, end,
+                                         extent if nested else None)
+            self.clear()
+        return results
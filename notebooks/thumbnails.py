@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import struct
+import sys
+import textwrap
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import colormaps
+
+"""
+Fast PNG thumbnails of contact matrices
+
+The colormaps of colormaps.py are converted once into uint8 lookup tables;
+matrices are normalized (optional log scaling, vmin/vmax, NaN colour) and
+colour-mapped in pure numpy, then written as PNG by a small zlib encoder.
+No matplotlib figure is created, and the worker processes do not import
+matplotlib at all (the lookup table is sent to them).
+
+For a campaign, each matrix gives one thumbnail, and all the thumbnails are
+assembled into contact sheets with a tile pyramid (each level halves the
+size of the previous one) and an index of the tile positions.
+"""
+
+BAD_COLOR = "#AAAAAA"
+
+
+def eprint(*args, **kwargs):
+    print(*args,  file=sys.stderr, **kwargs)
+
+
+def hex_to_rgba(color):
+    """Converts #RRGGBB or #RRGGBBAA into a uint8 RGBA array"""
+    color = color.lstrip("#")
+    if len(color) == 6:
+        color += "ff"
+    return np.array([int(color[i:i+2], 16) for i in range(0, 8, 2)], dtype=np.uint8)
+
+
+def normalize(stack, vmin=None, vmax=None, log=False):
+    """
+    Scales matrices into [0, 1], NaN (and non positive values if log) stay NaN
+
+    Parameters
+    ----------
+    stack: np.ndarray
+        a (N, N) matrix or a (B, N, N) stack
+    vmin, vmax: float
+        the values mapped to 0 and 1, by default the finite minimum and maximum
+        of each matrix
+    log: bool
+        log scale the values before normalization (vmin and vmax are then
+        given in the log scale)
+    """
+    stack = np.array(stack, dtype=np.float64, ndmin=3)
+    if log:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            stack = np.log(np.where(stack > 0, stack, np.nan))
+    finite = np.isfinite(stack)
+    masked = np.where(finite, stack, np.nan)
+    axes = (1, 2)
+    if vmin is None:
+        lo = np.where(finite, stack, np.inf).min(axis=axes, keepdims=True)
+    else:
+        lo = np.full((stack.shape[0], 1, 1), vmin, dtype=np.float64)
+    if vmax is None:
+        hi = np.where(finite, stack, -np.inf).max(axis=axes, keepdims=True)
+    else:
+        hi = np.full((stack.shape[0], 1, 1), vmax, dtype=np.float64)
+    span = np.where(hi > lo, hi - lo, 1)
+    return np.clip((masked - lo) / span, 0, 1)
+
+
+def apply_lut(normalized, lut, bad=BAD_COLOR):
+    """
+    Colour maps normalized values with a (n, 4) uint8 lookup table
+
+    Returns
+    -------
+    np.ndarray
+        uint8 RGBA images of shape normalized.shape + (4,)
+    """
+    nan = np.isnan(normalized)
+    index = np.rint(np.nan_to_num(normalized) * (len(lut) - 1)).astype(np.intp)
+    images = lut[index]
+    images[nan] = hex_to_rgba(bad)
+    return images
+
+
+def bin_images(images, factor):
+    """Shrinks (..., H, W, 4) uint8 images by averaging factor x factor blocks"""
+    if factor == 1:
+        return images
+    *lead, height, width, channels = images.shape
+    height, width = height // factor, width // factor
+    images = images[..., :height * factor, :width * factor, :]
+    blocks = images.reshape(*lead, height, factor, width, factor, channels)
+    return np.rint(blocks.mean(axis=(-4, -2))).astype(np.uint8)
+
+
+def write_png(output, image, level=6):
+    """Writes a (H, W, 4) or (H, W, 3) uint8 image as PNG"""
+    height, width, channels = image.shape
+    raw = np.empty((height, 1 + width * channels), dtype=np.uint8)
+    raw[:, 0] = 0  # filter type None for every row
+    raw[:, 1:] = image.reshape(height, width * channels)
+
+    def chunk(tag, data):
+        return (struct.pack(">I", len(data)) + tag + data +
+                struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+
+    color_type = 6 if channels == 4 else 2
+    with open(output, "wb") as fout:
+        fout.write(b"\x89PNG\r\n\x1a\n")
+        fout.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)))
+        fout.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), level)))
+        fout.write(chunk(b"IEND", b""))
+
+
+def thumbnail_paths(output_dir, paths):
+    """
+    Returns one PNG path per matrix file, named after the path of the matrix
+    relative to the common directory of all the files (directories joined
+    with "__"), so that mutants of different directories do not collide
+    """
+    paths = [os.path.abspath(path) for path in paths]
+    if not paths:
+        return []
+    root = os.path.commonpath([os.path.dirname(path) for path in paths])
+    names = [os.path.splitext(os.path.relpath(path, root))[0].replace(os.sep, "__")
+             for path in paths]
+    if len(set(names)) != len(names):
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        raise ValueError("matrices with the same thumbnail name: %s" % ", ".join(duplicates[:5]))
+    return [os.path.join(output_dir, name + ".png") for name in names]
+
+
+def _render_files(paths, outputs, lut, vmin, vmax, log, bad, binning, sheet_binning):
+    """
+    Worker: renders a chunk of matrix files, writes one PNG per matrix and
+    returns the tiles of the contact sheet
+    """
+    matrices = np.array([np.loadtxt(path, comments="#", delimiter="\t") for path in paths])
+    images = bin_images(apply_lut(normalize(matrices, vmin, vmax, log), lut, bad), binning)
+    for output, image in zip(outputs, images):
+        write_png(output, image)
+    return bin_images(images, sheet_binning)
+
+
+def contact_sheets(tiles, output_dir, columns=20, rows=20, levels=3, gap=2, name="sheet"):
+    """
+    Assembles tiles into contact sheet pages and their tile pyramid
+
+    Parameters
+    ----------
+    tiles: np.ndarray
+        (B, h, w, 4) uint8 tiles
+    columns, rows: int
+        tiles per row and rows per page
+    levels: int
+        number of pyramid levels, level 0 is full size and each following
+        level halves the previous one
+    gap: int
+        transparent pixels between tiles
+    Returns
+    -------
+    list
+        the written files
+    """
+    per_page = columns * rows
+    written = []
+    for page, lo in enumerate(range(0, len(tiles), per_page)):
+        written.extend(write_page(tiles[lo:lo + per_page], page, output_dir, columns, levels,
+                                  gap, name))
+    return written
+
+
+def write_page(page_tiles, page, output_dir, columns=20, levels=3, gap=2, name="sheet"):
+    """Writes one contact sheet page and its tile pyramid, see contact_sheets"""
+    count, height, width, channels = page_tiles.shape
+    used_rows = -(-count // columns)
+    sheet = np.zeros((used_rows * (height + gap), columns * (width + gap), channels),
+                     dtype=np.uint8)
+    for k, tile in enumerate(page_tiles):
+        row, col = divmod(k, columns)
+        y, x = row * (height + gap), col * (width + gap)
+        sheet[y:y + height, x:x + width] = tile
+    written = []
+    for level in range(levels):
+        output = os.path.join(output_dir, "%s_%03d_z%d.png" % (name, page, level))
+        write_png(output, sheet)
+        written.append(output)
+        if min(sheet.shape[:2]) < 4:
+            break
+        sheet = bin_images(sheet, 2)
+    return written
+
+
+def _write_full_pages(buffered, page, per_page, output_dir, columns, levels, written):
+    """Writes the complete pages of the buffered tile arrays, returns the next page number"""
+    while sum(len(tiles) for tiles in buffered) >= per_page:
+        tiles = np.concatenate(buffered)
+        written.extend(write_page(tiles[:per_page], page, output_dir, columns, levels))
+        buffered[:] = [tiles[per_page:]] if len(tiles) > per_page else []
+        page += 1
+    return page
+
+
+def render_campaign(paths, output_dir, cmap="hnh_cmap_ext5", vmin=None, vmax=None, log=False,
+                    bad=BAD_COLOR, binning=1, sheet_binning=2, columns=20, rows=20,
+                    levels=3, processes=None, chunk=64):
+    """
+    Renders the thumbnails and the contact sheets of a set of matrix files
+
+    Parameters
+    ----------
+    paths: list
+        the matrix files (as written by dump_target_matrix)
+    output_dir: str
+        the output directory
+    cmap: str
+        a colormap name of colormaps.py
+    vmin, vmax: float
+        the colour range, by default the range of each matrix
+    log: bool
+        log scale the values
+    bad: str
+        the colour of NaN pixels
+    binning: int
+        shrink factor of the thumbnails
+    sheet_binning: int
+        additional shrink factor of the tiles of the contact sheets
+    processes: int
+        number of worker processes (default: number of cpus)
+    chunk: int
+        number of matrices rendered per task
+    """
+    if not paths:
+        return []
+    os.makedirs(output_dir, exist_ok=True)
+    lut = colormaps.lut(cmap)
+    outputs = thumbnail_paths(output_dir, paths)
+    chunks = [(paths[lo:lo + chunk], outputs[lo:lo + chunk])
+              for lo in range(0, len(paths), chunk)]
+    per_page = columns * rows
+    written = []
+    pending, buffered, page = deque(), [], 0
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # a bounded number of chunks is in flight and results are consumed in
+        # submission order (the sheet order); each page is written as soon as
+        # its tiles have arrived, so that only one page of tiles is kept
+        in_flight = 2 * (processes or os.cpu_count())
+        for part, part_outputs in chunks:
+            pending.append(executor.submit(_render_files, part, part_outputs, lut, vmin, vmax,
+                                           log, bad, binning, sheet_binning))
+            if len(pending) < in_flight:
+                continue
+            buffered.append(pending.popleft().result())
+            page = _write_full_pages(buffered, page, per_page, output_dir, columns, levels,
+                                     written)
+        while pending:
+            buffered.append(pending.popleft().result())
+            page = _write_full_pages(buffered, page, per_page, output_dir, columns, levels,
+                                     written)
+    if buffered:
+        written.extend(write_page(np.concatenate(buffered), page, output_dir, columns, levels))
+
+    with open(os.path.join(output_dir, "sheet_index.tsv"), "w") as fout:
+        fout.write("page\trow\tcolumn\tthumbnail\tmatrix\n")
+        for k, (path, output) in enumerate(zip(paths, outputs)):
+            page, position = divmod(k, per_page)
+            row, col = divmod(position, columns)
+            fout.write("%d\t%d\t%d\t%s\t%s\n" % (page, row, col, output, path))
+    return written
+
+
+def read_paths(listfile):
+    with open(listfile, "r") as fin:
+        return [line.strip() for line in fin if line.strip() and not line.startswith("#")]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=textwrap.dedent('''\
+                                     Render PNG thumbnails and contact sheets of Orca matrices
+                                     '''))
+    parser.add_argument('--matrices',
+                        required=True, help='a file listing the matrix files, one per line')
+    parser.add_argument('--outdir',
+                        required=True, help='the output directory')
+    parser.add_argument('--cmap', default="hnh_cmap_ext5",
+                        required=False, help='the colormap name (default: hnh_cmap_ext5)')
+    parser.add_argument('--vmin', type=float,
+                        required=False, help='lower bound of the colour range')
+    parser.add_argument('--vmax', type=float,
+                        required=False, help='upper bound of the colour range')
+    parser.add_argument('--log', action="store_true",
+                        help='log scale the values (default: False)')
+    parser.add_argument('--bad', default=BAD_COLOR,
+                        required=False, help='NaN colour (default: %s)' % BAD_COLOR)
+    parser.add_argument('--binning', type=int, default=1,
+                        required=False, help='shrink factor of the thumbnails (default: 1)')
+    parser.add_argument('--levels', type=int, default=3,
+                        required=False, help='levels of the contact sheet pyramid (default: 3)')
+    parser.add_argument('--processes', type=int,
+                        required=False, help='number of worker processes (default: cpu count)')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    paths = read_paths(args.matrices)
+    written = render_campaign(paths, args.outdir, args.cmap, args.vmin, args.vmax, args.log,
+                              args.bad, args.binning, levels=args.levels,
+                              processes=args.processes)
+    eprint("%d thumbnails and %d contact sheets written" % (len(paths), len(written)))
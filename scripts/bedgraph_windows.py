@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import sys
+import textwrap
+
+import numpy as np
+import pandas as pd
+
+from intervals import read_chromsizes
+from orcaio import NBINS
+
+"""
+Streaming summary of a bedGraph track (for example hg38.phastCons20way, see
+ComparativeGenomics.md) into non overlapping windows of fixed size
+
+The bedGraph, sorted by chromosome and start as produced by bigWigToBedGraph,
+is read by large chunks with the pandas C parser. Each interval is split at the
+window boundaries and the resulting (window, value, bases) segments give, for
+every window, the exact mean and the exact median of the per-base values.
+Only the segments of the last, still open, window are carried from one chunk
+to the next, so that the memory is bounded by the chunk size and the output
+arrays.
+
+For each chromosome, three memory-mapped arrays are written
+
+<prefix>.<chrom>.mean.npy, <prefix>.<chrom>.median.npy, <prefix>.<chrom>.coverage.npy
+
+(windows without data are NaN, coverage is the number of covered bases) with
+a <prefix>.json description. to_orca_bins re-bins them on the nbins grid of a
+prediction matrix so that they can be joined with dump_target_matrix outputs.
+"""
+
+
+def eprint(*args, **kwargs):
+    print(*args,  file=sys.stderr, **kwargs)
+
+
+def track_path(prefix, chrom, stat):
+    return "%s.%s.%s.npy" % (prefix, chrom, stat)
+
+
+def read_chunks(bedgraph, chunksize=5_000_000):
+    """Yields (chroms, starts, ends, values) numpy columns of chunksize lines"""
+    reader = pd.read_csv(bedgraph, sep="\t", header=None, comment="#", chunksize=chunksize,
+                         names=["chrom", "start", "end", "value"], usecols=[0, 1, 2, 3],
+                         dtype={"chrom": str, "start": np.int64, "end": np.int64,
+                                "value": np.float64}, engine="c")
+    for chunk in reader:
+        yield (chunk["chrom"].to_numpy(), chunk["start"].to_numpy(),
+               chunk["end"].to_numpy(), chunk["value"].to_numpy())
+
+
+def split_segments(starts, ends, values, window):
+    """
+    Splits intervals at the window boundaries
+
+    Returns
+    -------
+    tuple
+        (windows, values, bases) of the segments, sorted by window
+    """
+    first = starts // window
+    last = (ends - 1) // window
+    nsegments = last - first + 1
+    interval = np.repeat(np.arange(len(starts)), nsegments)
+    offsets = np.cumsum(nsegments) - nsegments
+    windows = first[interval] + np.arange(len(interval)) - offsets[interval]
+    seg_starts = np.maximum(starts[interval], windows * window)
+    seg_ends = np.minimum(ends[interval], (windows + 1) * window)
+    return windows, values[interval], seg_ends - seg_starts
+
+
+def window_statistics(windows, values, bases):
+    """
+    Exact per-window mean and median of per-base values
+
+    Parameters
+    ----------
+    windows, values, bases: np.ndarray
+        segments, as returned by split_segments
+    Returns
+    -------
+    tuple
+        (window indices, means, medians, covered bases)
+    """
+    order = np.lexsort((values, windows))
+    windows, values, bases = windows[order], values[order], bases[order]
+    first = np.flatnonzero(np.append(True, windows[1:] != windows[:-1]))
+    coverage = np.add.reduceat(bases, first)
+    means = np.add.reduceat(values * bases, first) / coverage
+
+    # ranks of the middle bases: the median of n bases is the mean of the
+    # values of ranks (n-1)//2 and n//2
+    cumulated = np.cumsum(bases)
+    before = cumulated[first] - bases[first]
+    lower = np.searchsorted(cumulated, before + (coverage - 1) // 2, side="right")
+    upper = np.searchsorted(cumulated, before + coverage // 2, side="right")
+    medians = (values[lower] + values[upper]) / 2
+    return windows[first], means, medians, coverage
+
+
+class WindowAggregator():
+    """
+    Accumulates a sorted bedGraph stream into per-window mean and median arrays
+
+    Parameters
+    ----------
+    prefix: str
+        the output prefix
+    chromsizes: dict
+        chromosome name -> length, see intervals.read_chromsizes
+    window: int
+        the window size in bp
+    """
+    def __init__(self, prefix, chromsizes, window=50):
+        self.prefix = prefix
+        self.chromsizes = chromsizes
+        self.window = window
+        self.chrom = None
+        self.done = []
+        self.arrays = {}
+        self.carry = None
+        self.last_end = 0
+
+    def _open(self, chrom):
+        if chrom not in self.chromsizes:
+            raise ValueError("chromosome %s is not in the genome index" % chrom)
+        if chrom in self.done:
+            raise ValueError("the bedGraph is not sorted, chromosome %s found twice" % chrom)
+        self._close_chrom()
+        self.chrom = chrom
+        self.last_end = 0
+        nwindows = -(-self.chromsizes[chrom] // self.window)
+        for stat, dtype, fill in [("mean", np.float32, np.nan), ("median", np.float32, np.nan),
+                                  ("coverage", np.int32, 0)]:
+            array = np.lib.format.open_memmap(track_path(self.prefix, chrom, stat), mode="w+",
+                                              dtype=dtype, shape=(nwindows,))
+            array[:] = fill
+            self.arrays[stat] = array
+
+    def _write(self, segments):
+        if len(segments[0]) == 0:
+            return
+        windows, means, medians, coverage = window_statistics(*segments)
+        self.arrays["mean"][windows] = means
+        self.arrays["median"][windows] = medians
+        self.arrays["coverage"][windows] = coverage
+
+    def _close_chrom(self):
+        if self.chrom is None:
+            return
+        if self.carry is not None and len(self.carry[0]):
+            self._write(self.carry)
+        for array in self.arrays.values():
+            array.flush()
+        self.done.append(self.chrom)
+        self.arrays, self.carry, self.chrom = {}, None, None
+
+    def _add_chrom(self, chrom, starts, ends, values):
+        if chrom != self.chrom:
+            self._open(chrom)
+        if starts[0] < self.last_end or np.any(starts[1:] < ends[:-1]):
+            raise ValueError("the bedGraph must be sorted and non overlapping (%s)" % chrom)
+        if ends[-1] > self.chromsizes[chrom]:
+            raise ValueError("interval outside chromosome %s" % chrom)
+        self.last_end = ends[-1]
+        segments = split_segments(starts, ends, values, self.window)
+        if self.carry is not None:
+            segments = tuple(np.concatenate(pair) for pair in zip(self.carry, segments))
+        # the last window may continue in the next chunk
+        closed = segments[0] < segments[0][-1]
+        self._write(tuple(column[closed] for column in segments))
+        self.carry = tuple(column[~closed] for column in segments)
+
+    def add(self, chroms, starts, ends, values):
+        """Adds a chunk of bedGraph lines (columns as numpy arrays)"""
+        if len(chroms) == 0:
+            return
+        changes = np.flatnonzero(chroms[1:] != chroms[:-1]) + 1
+        bounds = np.concatenate(([0], changes, [len(chroms)]))
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            self._add_chrom(chroms[lo], starts[lo:hi], ends[lo:hi], values[lo:hi])
+
+    def close(self):
+        self._close_chrom()
+        with open("%s.json" % self.prefix, "w") as fout:
+            json.dump({"window": self.window, "chromosomes": self.done,
+                       "chromsizes": {chrom: self.chromsizes[chrom] for chrom in self.done}},
+                      fout, indent=2)
+
+
+def aggregate(bedgraph, genome, prefix, window=50, chunksize=5_000_000):
+    """Summarizes a bedGraph into window arrays, see WindowAggregator"""
+    aggregator = WindowAggregator(prefix, read_chromsizes(genome), window)
+    lines = 0
+    for chunk in read_chunks(bedgraph, chunksize):
+        aggregator.add(*chunk)
+        lines += len(chunk[0])
+        eprint("%d lines processed" % lines)
+    aggregator.close()
+    return aggregator.done
+
+
+def load_track(prefix, chrom, stat="mean"):
+    """Memory-maps a window array written by aggregate"""
+    return np.load(track_path(prefix, chrom, stat), mmap_mode="r")
+
+
+def to_orca_bins(prefix, chrom, start, end, nbins=NBINS):
+    """
+    Re-bins the window arrays on the grid of a prediction matrix
+
+    The windows are clipped to [start, end) and the windows straddling a bin
+    edge are split between the bins in proportion to their overlap. The bin
+    means are exact when start and the bin edges are multiples of the window
+    size; otherwise the coverage of a split window is assumed uniform inside
+    it. The bin medians are the medians of the medians of the windows
+    overlapping the bins.
+
+    Parameters
+    ----------
+    prefix: str
+        the prefix given to aggregate
+    chrom, start, end: str, int, int
+        the region of the matrix, as in the dump_target_matrix headers
+    nbins: int
+        the matrix size
+    Returns
+    -------
+    tuple
+        (means, medians, coverage) arrays of size nbins
+    """
+    with open("%s.json" % prefix, "r") as fin:
+        description = json.load(fin)
+    window = description["window"]
+    chromlen = description["chromsizes"][chrom]
+    mean = load_track(prefix, chrom, "mean")
+    median = load_track(prefix, chrom, "median")
+    coverage = load_track(prefix, chrom, "coverage")
+
+    first = max(start // window, 0)
+    last = min(-(-end // window), len(mean))
+    positions = np.arange(first, last, dtype=np.int64) * window
+    lengths = np.minimum(positions + window, chromlen) - positions
+    clipped_starts = np.maximum(positions, start)
+    clipped_ends = np.minimum(positions + window, min(end, chromlen))
+    keep = clipped_ends > clipped_starts
+    windows = np.arange(first, last)[keep]
+    clipped_starts, clipped_ends, lengths = clipped_starts[keep], clipped_ends[keep], lengths[keep]
+
+    # split the windows at the bin edges, as split_segments
+    edges = start + np.arange(nbins + 1, dtype=np.int64) * (end - start) // nbins
+    first_bin = np.searchsorted(edges, clipped_starts, side="right") - 1
+    last_bin = np.searchsorted(edges, clipped_ends - 1, side="right") - 1
+    nsegments = last_bin - first_bin + 1
+    segment = np.repeat(np.arange(len(windows)), nsegments)
+    offsets = np.cumsum(nsegments) - nsegments
+    bins = first_bin[segment] + np.arange(len(segment)) - offsets[segment]
+    overlap = (np.minimum(clipped_ends[segment], edges[bins + 1]) -
+               np.maximum(clipped_starts[segment], edges[bins]))
+    fraction = overlap / lengths[segment]
+    windows = windows[segment]
+
+    window_coverage = np.asarray(coverage[first:last], dtype=np.float64)[windows - first]
+    window_means = np.nan_to_num(np.asarray(mean[first:last], dtype=np.float64)[windows - first])
+    bin_coverage = np.bincount(bins, window_coverage * fraction, minlength=nbins)[:nbins]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        bin_means = (np.bincount(bins, window_means * window_coverage * fraction,
+                                 minlength=nbins)[:nbins] / bin_coverage)
+    bin_means[bin_coverage == 0] = np.nan
+
+    window_medians = np.asarray(median[first:last], dtype=np.float64)[windows - first]
+    bin_medians = np.full(nbins, np.nan)
+    bounds = np.searchsorted(bins, np.arange(nbins + 1))
+    for k in range(nbins):
+        values = window_medians[bounds[k]:bounds[k+1]]
+        values = values[np.isfinite(values)]
+        if len(values):
+            bin_medians[k] = np.median(values)
+    return bin_means, bin_medians, bin_coverage
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=textwrap.dedent('''\
+                                     Summarize a sorted bedGraph into mean and median per window
+                                     '''))
+    parser.add_argument('--bedgraph',
+                        required=True, help='the bedGraph file (may be gzipped)')
+    parser.add_argument('--genome',
+                        required=True, help='the fasta index or chrom sizes file')
+    parser.add_argument('--window', type=int, default=50,
+                        required=False, help='the window size (default: 50)')
+    parser.add_argument('--chunksize', type=int, default=5_000_000,
+                        required=False, help='bedGraph lines read at once (default: 5000000)')
+    parser.add_argument('--outprefix',
+                        required=True, help='the output prefix')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    aggregate(args.bedgraph, args.genome, args.outprefix, args.window, args.chunksize)
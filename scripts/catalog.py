@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import hashlib
+import os
+import sqlite3
+import sys
+import textwrap
+
+from orcaio import NBINS, parse_header, mutation_position, load_stack
+
+"""
+Indexed catalog of the matrices written by dump_target_matrix
+
+The output directories are scanned recursively; only the header line of the
+new or modified files (by mtime) is parsed and stored in a local SQLite
+database. The catalog can then be queried by metadata, for example all the
+1Mb predictions on chromosome 1 with a mutation within 100 kb of a position:
+
+    catalog = Catalog("orca.db")
+    catalog.scan(["campaign1", "campaign2"])
+    paths = catalog.query(kind="predictions", resol="1Mb", chrom="1",
+                          near=1_250_000, distance=100_000)
+    stack = catalog.load(paths)
+"""
+
+COLUMNS = [("kind", "TEXT"), ("model", "TEXT"), ("resol", "TEXT"),
+           ("chrom", "TEXT"), ("start", "INTEGER"), ("end", "INTEGER"),
+           ("mpos", "INTEGER"), ("wpos", "INTEGER"), ("nbins", "INTEGER"),
+           ("width", "INTEGER"), ("chromlen", "INTEGER"), ("mutation", "TEXT"),
+           ("mutation_pos", "INTEGER")]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS matrices (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    %s
+);
+CREATE INDEX IF NOT EXISTS matrices_region ON matrices (kind, resol, chrom, start);
+CREATE INDEX IF NOT EXISTS matrices_mutation ON matrices (chrom, mutation_pos);
+""" % ",\n    ".join('"%s" %s' % column for column in COLUMNS)
+
+
+def eprint(*args, **kwargs):
+    print(*args,  file=sys.stderr, **kwargs)
+
+
+def _walk(directory, suffix):
+    """Yields (path, mtime) of the files ending with suffix below directory"""
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(suffix):
+                    yield os.path.abspath(entry.path), entry.stat().st_mtime
+
+
+def _record(path, mtime):
+    """
+    Reads the header of a matrix file; a file that is not an Orca matrix is
+    recorded with a NULL kind, so that the following scans skip it
+    """
+    with open(path, "r", errors="replace") as fin:
+        line = fin.readline()
+    if not line.startswith("# Orca="):
+        return [path, mtime] + [None] * len(COLUMNS)
+    header = parse_header(line)
+    header["kind"] = header.get("Orca")
+    header["mutation_pos"] = mutation_position(header)
+    if "mutation" in header:
+        header["mutation"] = str(header["mutation"])
+    return [path, mtime] + [header.get(name) for name, _ in COLUMNS]
+
+
+class Catalog():
+    """
+    SQLite index of Orca prediction outputs
+
+    Parameters
+    ----------
+    database: str
+        the SQLite file, created if needed
+    """
+    def __init__(self, database):
+        self.database = database
+        self.connection = sqlite3.connect(database)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def scan(self, directories, suffix=".txt"):
+        """
+        Indexes the new and modified matrices of directories, forgets the removed ones
+
+        Returns
+        -------
+        tuple
+            (number of indexed files, number of removed files); files that are
+            not Orca matrices are indexed with a NULL kind and never returned
+            by query
+        """
+        placeholders = ", ".join("?" * (len(COLUMNS) + 2))
+        indexed, removed = 0, 0
+        for directory in directories:
+            root = os.path.join(os.path.abspath(directory), "")
+            known = dict(self.connection.execute(
+                "SELECT path, mtime FROM matrices WHERE path LIKE ? ESCAPE '\\'",
+                (root.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%",)))
+            records = []
+            for path, mtime in _walk(directory, suffix):
+                if known.pop(path, None) == mtime:
+                    continue
+                records.append(_record(path, mtime))
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO matrices VALUES (%s)" % placeholders, records)
+                self.connection.executemany("DELETE FROM matrices WHERE path = ?",
+                                            [(path,) for path in known])
+            indexed += len(records)
+            removed += len(known)
+        return indexed, removed
+
+    def query(self, kind=None, resol=None, chrom=None, near=None, distance=0,
+              start=None, end=None, mutated=None, **fields):
+        """
+        Returns the paths of the matrices matching the given metadata
+
+        Parameters
+        ----------
+        kind: str
+            predictions or normmats
+        resol: str
+            the resolution, for example 1Mb
+        chrom: str
+            the chromosome
+        near: int
+            keep the matrices whose mutation lies within distance bp of near
+        distance: int
+            see near
+        start, end: int
+            keep the matrices overlapping [start, end)
+        mutated: bool
+            keep only the matrices with (True) or without (False) a mutation
+        fields:
+            other header fields tested for equality (mpos, wpos, model, ...)
+        Returns
+        -------
+        list
+            the matching paths sorted by chromosome, start and path
+        """
+        clauses, values = ["kind IS NOT NULL"], []
+        for name, value in [("kind", kind), ("resol", resol), ("chrom", chrom)]:
+            if value is not None:
+                clauses.append('"%s" = ?' % name)
+                values.append(str(value))
+        for name, value in fields.items():
+            if name not in dict(COLUMNS):
+                raise ValueError("%s is not a catalog field" % name)
+            clauses.append('"%s" = ?' % name)
+            values.append(value)
+        if near is not None:
+            clauses.append("mutation_pos BETWEEN ? AND ?")
+            values.extend([near - distance, near + distance])
+        if start is not None:
+            clauses.append('"end" > ?')
+            values.append(start)
+        if end is not None:
+            clauses.append("start < ?")
+            values.append(end)
+        if mutated is not None:
+            clauses.append("mutation_pos IS %s NULL" % ("NOT" if mutated else ""))
+        sql = "SELECT path FROM matrices WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY chrom, start, path"
+        return [row[0] for row in self.connection.execute(sql, values)]
+
+    def headers(self, paths):
+        """Returns the stored metadata of paths as dictionnaries"""
+        names = ["path", "mtime"] + [name for name, _ in COLUMNS]
+        rows = {}
+        for lo in range(0, len(paths), 500):
+            chunk = paths[lo:lo+500]
+            sql = "SELECT * FROM matrices WHERE path IN (%s)" % ", ".join("?" * len(chunk))
+            for row in self.connection.execute(sql, chunk):
+                rows[row[0]] = dict(zip(names, row))
+        return [rows[path] for path in paths]
+
+    def stack_path(self, paths):
+        """Returns the default .npy cache of a list of paths, in <database>.stacks"""
+        digest = hashlib.sha1("\n".join(paths).encode()).hexdigest()[:16]
+        return os.path.join("%s.stacks" % self.database, "%s.npy" % digest)
+
+    def load(self, paths, cache=None, nbins=NBINS):
+        """
+        Loads the matrices of paths as a memory-mapped stack, see orcaio.load_stack
+
+        The stack is cached in cache, by default in a file of <database>.stacks
+        named after the ordered paths (for example the result of a query)
+        """
+        if cache is None:
+            cache = self.stack_path(paths)
+            os.makedirs(os.path.dirname(cache), exist_ok=True)
+        return load_stack(paths, cache, nbins)
+
+
+def main_scan(database, directories):
+    with Catalog(database) as catalog:
+        indexed, removed = catalog.scan(directories)
+    eprint("%d files indexed, %d removed" % (indexed, removed))
+
+
+def main_query(database, **kwargs):
+    with Catalog(database) as catalog:
+        for path in catalog.query(**kwargs):
+            print(path)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=textwrap.dedent('''\
+                                     Index Orca prediction outputs and query them by metadata
+                                     '''))
+    parser.add_argument('--db',
+                        required=True, help='the SQLite catalog file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    scan = subparsers.add_parser('scan', help='index new and modified outputs')
+    scan.add_argument('directories', nargs='+', help='the output directories')
+
+    query = subparsers.add_parser('query', help='print the paths matching the metadata')
+    query.add_argument('--kind', choices=["predictions", "normmats"], help='matrix kind')
+    query.add_argument('--resol', help='resolution, for example 1Mb')
+    query.add_argument('--chrom', help='chrom name')
+    query.add_argument('--near', type=int, help='mutation close to this coordinate')
+    query.add_argument('--distance', type=int, default=0,
+                       help='maximum distance between the mutation and --near (default: 0)')
+    query.add_argument('--start', type=int, help='keep the matrices ending after start')
+    query.add_argument('--end', type=int, help='keep the matrices starting before end')
+    query.add_argument('--mutated', choices=["yes", "no"],
+                       help='keep only the matrices with (yes) or without (no) a mutation')
+    query.add_argument('--mpos', type=int, help='the mpos of the prediction')
+    query.add_argument('--wpos', type=int, help='the wpos of the prediction')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    if args.command == 'scan':
+        main_scan(args.db, args.directories)
+    else:
+        fields = {name: value for name, value in [("mpos", args.mpos), ("wpos", args.wpos)]
+                  if value is not None}
+        mutated = None if args.mutated is None else args.mutated == "yes"
+        main_query(args.db, kind=args.kind, resol=args.resol, chrom=args.chrom,
+                   near=args.near, distance=args.distance, start=args.start, end=args.end,
+                   mutated=mutated, **fields)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import textwrap
+
+import numpy as np
+import pandas as pd
+
+from orcaio import RESOLUTIONS, matrix_path, read_header, read_matrix, mutation_bin, load_stack
+
+"""
+Batched comparison of mutant predictions against the wild type prediction
+
+For one resolution, the matrices of all the mutants are stacked into a
+(B, 250, 250) array (memory-mapped from a .npy cache) and compared to the
+reference matrix in vectorized form:
+  - difference maps (mutant - reference)
+  - Pearson and Spearman correlations over the upper triangle
+  - stratum-adjusted correlation (SCC, HiCRep) computed diagonal per diagonal
+  - insulation score deltas around the mutation bin recorded in the headers
+
+The metrics of every mutant and resolution are gathered in one tidy table.
+"""
+
+
+def eprint(*args, **kwargs):
+    print(*args,  file=sys.stderr, **kwargs)
+
+
+def _rank(x):
+    """Ranks along the last axis, tied values get their average rank"""
+    x = np.asarray(x)
+    if x.ndim == 1:
+        return pd.Series(x).rank().to_numpy(dtype=np.float64)
+    return pd.DataFrame(x).rank(axis=1).to_numpy(dtype=np.float64)
+
+
+def _pearson(x, y, rtol=1e-6):
+    """
+    Pearson correlation between the rows of x (B, K) and y (K,)
+
+    The correlation is NaN when x or y is (nearly) constant, that is when its
+    standard deviation is below rtol times its largest absolute value: the
+    correlation would only measure floating point noise.
+    """
+    xc = x - x.mean(axis=-1, keepdims=True)
+    yc = y - y.mean()
+    num = xc @ yc
+    ssx = (xc * xc).sum(axis=-1)
+    ssy = (yc * yc).sum()
+    K = x.shape[-1]
+    flat_x = np.sqrt(ssx / K) <= rtol * np.abs(x).max(axis=-1)
+    flat_y = np.sqrt(ssy / K) <= rtol * np.abs(y).max()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        r = num / np.sqrt(ssx * ssy)
+    return np.where(flat_x | flat_y, np.nan, r)
+
+
+def difference_maps(stack, reference):
+    """Returns the (B, N, N) differences mutant - reference"""
+    return np.asarray(stack, dtype=np.float64) - reference[None, :, :]
+
+
+def correlations(stack, reference, valid, min_diag=1):
+    """
+    Pearson and Spearman correlations of each mutant with the reference
+
+    Parameters
+    ----------
+    stack: np.ndarray
+        the (B, N, N) mutant matrices
+    reference: np.ndarray
+        the (N, N) reference matrix
+    valid: np.ndarray
+        (N, N) mask of the pixels to use
+    min_diag: int
+        the first diagonal used (the upper triangle is used as matrices are symmetric)
+    Returns
+    -------
+    tuple
+        (pearson, spearman), two arrays of size B
+    """
+    mask = valid & np.triu(np.ones_like(valid), k=min_diag)
+    x = np.asarray(stack[:, mask], dtype=np.float64)
+    y = reference[mask].astype(np.float64)
+    return _pearson(x, y), _pearson(_rank(x), _rank(y))
+
+
+def stratum_adjusted_correlation(stack, reference, valid, max_diag=None, min_diag=1):
+    """
+    Stratum-adjusted correlation coefficient (HiCRep) of each mutant with the reference
+
+    Each diagonal d is a stratum; the per diagonal Pearson correlations r_d are
+    averaged with weights N_d * sqrt(var(rank(x_d)/N_d) var(rank(y_d)/N_d)).
+    Constant diagonals (as in normmats, which only depend on the distance) have
+    no defined r_d and get a weight of 0; the SCC is NaN if all diagonals are
+    constant.
+
+    Returns
+    -------
+    tuple
+        (scc, r_d): an array of size B and the (B, D) per diagonal correlations
+    """
+    B, N, _ = stack.shape
+    max_diag = N - 2 if max_diag is None else min(max_diag, N - 2)
+    diags = range(min_diag, max_diag + 1)
+    r_d = np.full((B, len(diags)), np.nan)
+    weights = np.zeros((B, len(diags)))
+    for k, d in enumerate(diags):
+        i = np.arange(N - d)
+        keep = valid[i, i + d]
+        n = keep.sum()
+        if n < 3:
+            continue
+        x = np.asarray(stack[:, i[keep], i[keep] + d], dtype=np.float64)
+        y = reference[i[keep], i[keep] + d].astype(np.float64)
+        r_d[:, k] = _pearson(x, y)
+        var_x = (_rank(x) / n).var(axis=-1)
+        var_y = (_rank(y) / n).var()
+        weights[:, k] = n * np.sqrt(var_x * var_y)
+    weights[~np.isfinite(r_d)] = 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scc = np.nansum(weights * np.nan_to_num(r_d), axis=1) / weights.sum(axis=1)
+    return scc, r_d
+
+
+def insulation(stack, w=5):
+    """
+    Insulation score of each bin, sum of the (w+1)x(w+1) square
+    mat[i-w:i+1, i:i+w+1] as in the OrcaMatrices notebook
+
+    Returns
+    -------
+    np.ndarray
+        (B, N) scores, NaN for the w bins on each border
+    """
+    stack = np.nan_to_num(np.asarray(stack, dtype=np.float64))
+    B, N, _ = stack.shape
+    # integral image, summed[:, r, c] = stack[:, :r, :c].sum()
+    summed = np.zeros((B, N + 1, N + 1))
+    summed[:, 1:, 1:] = stack.cumsum(axis=1).cumsum(axis=2)
+    i = np.arange(w, N - w)
+    r0, r1, c0, c1 = i - w, i + 1, i, i + w + 1
+    scores = np.full((B, N), np.nan)
+    scores[:, i] = (summed[:, r1, c1] - summed[:, r0, c1] -
+                    summed[:, r1, c0] + summed[:, r0, c0])
+    return scores
+
+
+def compare(stack, reference, mutation_bins, w=5, flank=10, max_diag=None, chunk=256):
+    """
+    Computes the comparison metrics of a stack of mutants, by chunks of mutants
+
+    Parameters
+    ----------
+    stack: np.ndarray
+        the (B, N, N) mutant matrices, possibly memory-mapped
+    reference: np.ndarray
+        the (N, N) reference matrix
+    mutation_bins: list
+        the mutation bin of each mutant (or None)
+    w: int
+        the insulation square size
+    flank: int
+        the number of bins on each side of the mutation bin for the insulation delta
+    max_diag: int
+        the last diagonal used by the stratum-adjusted correlation
+    chunk: int
+        the number of mutants processed at once
+    Returns
+    -------
+    dict
+        metric name -> array of size B
+    """
+    B, N, _ = stack.shape
+    reference = np.asarray(reference, dtype=np.float64)
+    valid = np.isfinite(reference)
+    for lo in range(0, B, chunk):
+        valid &= np.isfinite(stack[lo:lo+chunk]).all(axis=0)
+    ref_insulation = insulation(reference[None, :, :], w)[0]
+
+    bins = np.array([-1 if b is None else b for b in mutation_bins], dtype=np.int64)
+    metrics = {name: np.full(B, np.nan) for name in
+               ["mean_abs_diff", "max_abs_diff", "pearson", "spearman", "scc",
+                "insulation_delta", "max_abs_insulation_delta"]}
+    for lo in range(0, B, chunk):
+        hi = min(lo + chunk, B)
+        sub = np.asarray(stack[lo:hi], dtype=np.float64)
+        diff = np.abs(difference_maps(sub, reference))
+        diff[:, ~valid] = np.nan
+        metrics["mean_abs_diff"][lo:hi] = np.nanmean(diff, axis=(1, 2))
+        metrics["max_abs_diff"][lo:hi] = np.nanmax(diff, axis=(1, 2))
+        pearson, spearman = correlations(sub, reference, valid)
+        metrics["pearson"][lo:hi] = pearson
+        metrics["spearman"][lo:hi] = spearman
+        metrics["scc"][lo:hi], _ = stratum_adjusted_correlation(sub, reference, valid, max_diag)
+
+        delta = insulation(sub, w) - ref_insulation[None, :]
+        sub_bins = bins[lo:hi]
+        has_bin = sub_bins >= 0
+        rows = np.flatnonzero(has_bin)
+        metrics["insulation_delta"][lo + rows] = delta[rows, sub_bins[rows]]
+        offsets = np.arange(-flank, flank + 1)
+        cols = np.clip(sub_bins[rows, None] + offsets[None, :], 0, N - 1)
+        around = np.abs(delta[rows[:, None], cols])
+        around_max = np.where(np.isnan(around), -np.inf, around).max(axis=1, initial=-np.inf)
+        around_max[np.isinf(around_max)] = np.nan
+        metrics["max_abs_insulation_delta"][lo + rows] = around_max
+    return metrics
+
+
+def compare_resolution(reference_prefix, mutant_prefixes, resol, kind="predictions",
+                       cache_dir=None, diff_dir=None, **kwargs):
+    """
+    Compares all the mutants with the reference for one resolution
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per mutant
+    """
+    paths = [matrix_path(prefix, resol, kind) for prefix in mutant_prefixes]
+    headers = [read_header(path) for path in paths]
+    cache = None
+    if cache_dir is not None:
+        cache = os.path.join(cache_dir, "%s_%s_stack.npy" % (kind, resol))
+    stack = load_stack(paths, cache)
+    # rounded as the float32 mutant stack, so that identical inputs compare exactly
+    reference = read_matrix(matrix_path(reference_prefix, resol, kind)).astype(np.float32)
+    bins = [mutation_bin(header) for header in headers]
+
+    metrics = compare(stack, reference, bins, **kwargs)
+    if diff_dir is not None:
+        output = os.path.join(diff_dir, "%s_%s_diff.npy" % (kind, resol))
+        diffs = np.lib.format.open_memmap(output, mode="w+", dtype=np.float32, shape=stack.shape)
+        for lo in range(0, stack.shape[0], 256):
+            diffs[lo:lo+256] = difference_maps(stack[lo:lo+256], reference)
+        diffs.flush()
+
+    table = pd.DataFrame({
+        "mutant": mutant_prefixes,
+        "resol": resol,
+        "chrom": [header.get("chrom") for header in headers],
+        "start": [header.get("start") for header in headers],
+        "end": [header.get("end") for header in headers],
+        "mutation": [header.get("mutation") for header in headers],
+        "mutation_bin": bins,
+    })
+    for name, values in metrics.items():
+        table[name] = values
+    return table
+
+
+def main(reference, mutants, output, resolutions=RESOLUTIONS, kind="predictions",
+         cache_dir=None, diff_dir=None, window=5, flank=10):
+    for directory in [cache_dir, diff_dir]:
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+    tables = []
+    for resol in resolutions:
+        eprint("Comparing %d mutants at %s" % (len(mutants), resol))
+        tables.append(compare_resolution(reference, mutants, resol, kind, cache_dir,
+                                         diff_dir, w=window, flank=flank))
+    pd.concat(tables, ignore_index=True).to_csv(output, sep="\t", index=False)
+
+
+def read_prefixes(listfile):
+    with open(listfile, "r") as fin:
+        return [line.strip() for line in fin if line.strip() and not line.startswith("#")]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=textwrap.dedent('''\
+                                     Compare mutant predictions with the wild type prediction
+                                     '''))
+    parser.add_argument('--reference',
+                        required=True, help='the output prefix of the wild type prediction')
+    parser.add_argument('--mutants',
+                        required=True, help='a file listing the output prefixes of the mutants, one per line')
+    parser.add_argument('--output',
+                        required=True, help='the output tsv table')
+    parser.add_argument('--resol', nargs='+', default=RESOLUTIONS, choices=RESOLUTIONS,
+                        required=False, help='the resolutions to compare (default: all)')
+    parser.add_argument('--kind', default="predictions", choices=["predictions", "normmats"],
+                        required=False, help='the matrices to compare (default: predictions)')
+    parser.add_argument('--cachedir',
+                        required=False, help='directory of the memory-mapped matrix stacks (one per campaign)')
+    parser.add_argument('--diffdir',
+                        required=False, help='directory where the difference maps are written')
+    parser.add_argument('--window', type=int, default=5,
+                        required=False, help='insulation square size (default: 5)')
+    parser.add_argument('--flank', type=int, default=10,
+                        required=False, help='bins around the mutation for the insulation delta (default: 10)')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    main(args.reference, read_prefixes(args.mutants), args.output, args.resol, args.kind,
+         args.cachedir, args.diffdir, args.window, args.flank)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import sys
+import textwrap
+
+import numpy as np
+
+from compare_predictions import insulation
+from orcaio import NBINS
+from process_sequence_1Mb import pred_1Mb
+
+"""
+Systematic in-silico mutation scan of a 1Mb window with the Orca 1M model
+
+Every tile of k bp of the window is mutated in turn (mask, shuffle or
+inversion, the operations of mutate.Mutator) and the change of the predicted
+contacts is measured. The reference window is encoded once; the encoding of
+each mutant is obtained by patching only the rows of its tile in a batch
+buffer (and restoring the rows of the previous tile), and the mutants are run
+through the model in batches, in a single process.
+
+The encoding is the one of selene / orca_predict (rows A, C, G, T, N being
+0.25 everywhere), hence:
+  - mask: the tile rows are set to 0.25
+  - shuffle: the tile rows are permuted
+  - inversion: the tile rows are reversed and complemented (columns reversed)
+
+Outputs:
+  <prefix>_scan.tsv      one line per tile with its effect scores
+  <prefix>_scan.bedgraph the effect track (mean absolute difference of the tile bins)
+  <prefix>_scan.npy      optional, the (tiles, 250, 250) predicted matrices
+"""
+
+OPERATIONS = ["mask", "shuffle", "inversion"]
+WINDOW = 1_000_000
+
+
+def eprint(*args, **kwargs):
+    print(*args,  file=sys.stderr, **kwargs)
+
+
+def tile_bounds(length, tile, step=None):
+    """
+    Returns the (starts, ends) of the tiles covering [0, length)
+
+    The last tile is clipped at length when length is not a multiple of the
+    step, so that every base is scanned
+    """
+    step = tile if step is None else step
+    starts = np.arange(0, length, step, dtype=np.int64)
+    # the tiles after the first one reaching the end would only repeat its bases
+    last = np.searchsorted(starts + tile, length, side="left")
+    starts = starts[:last + 1]
+    return starts, np.minimum(starts + tile, length)
+
+
+def patch(encoding, reference, start, end, operation, rng=None):
+    """
+    Writes in encoding[start:end] the mutated rows of reference[start:end]
+
+    Parameters
+    ----------
+    encoding: np.ndarray
+        the (L, 4) encoding to modify in place
+    reference: np.ndarray
+        the (L, 4) reference encoding
+    start, end: int
+        the tile
+    operation: str
+        mask, shuffle or inversion
+    rng: np.random.Generator
+        random generator for shuffle
+    """
+    if operation == "mask":
+        encoding[start:end] = 0.25
+    elif operation == "shuffle":
+        rng = np.random.default_rng() if rng is None else rng
+        encoding[start:end] = reference[start:end][rng.permutation(end - start)]
+    elif operation == "inversion":
+        encoding[start:end] = reference[start:end][::-1, ::-1]
+    else:
+        raise ValueError("%s is not a valid operation" % operation)
+
+
+def iter_batches(reference, starts, ends, operation, batch_size=8, seed=0):
+    """
+    Yields (first tile index, (b, L, 4) batch of mutant encodings)
+
+    A single buffer is reused: for each slot only the rows of the previous tile
+    are restored from the reference before the rows of the new tile are patched.
+    """
+    rng = np.random.default_rng(seed)
+    buffer = np.repeat(reference[None, :, :], min(batch_size, len(starts)), axis=0)
+    previous = [None] * len(buffer)
+    for lo in range(0, len(starts), batch_size):
+        count = min(batch_size, len(starts) - lo)
+        for slot in range(count):
+            if previous[slot] is not None:
+                old_start, old_end = previous[slot]
+                buffer[slot, old_start:old_end] = reference[old_start:old_end]
+            start, end = starts[lo + slot], ends[lo + slot]
+            patch(buffer[slot], reference, start, end, operation, rng)
+            previous[slot] = (start, end)
+        yield lo, buffer[:count]
+
+
+def effect_scores(predictions, reference, starts, ends, length=WINDOW, w=5):
+    """
+    Reduces the mutant predictions to per-tile effect scores
+
+    Parameters
+    ----------
+    predictions: np.ndarray
+        the (B, N, N) mutant predictions
+    reference: np.ndarray
+        the (N, N) reference prediction
+    starts, ends: np.ndarray
+        the tiles of the mutants, relative to the window
+    length: int
+        the window size
+    w: int
+        the insulation square size
+    Returns
+    -------
+    dict
+        score name -> array of size B
+          - mean_abs_diff: over the whole matrix
+          - tile_abs_diff: over the rows of the bins overlapping the tile
+          - insulation_delta: at the bin of the tile center
+    """
+    B, N, _ = predictions.shape
+    diff = np.abs(predictions - reference[None, :, :])
+    first = starts * N // length
+    last = (ends - 1) * N // length
+    rows = np.arange(N)
+    in_tile = (rows[None, :] >= first[:, None]) & (rows[None, :] <= last[:, None])
+    row_means = np.nanmean(diff, axis=2)
+    tile_abs_diff = (np.nan_to_num(row_means) * in_tile).sum(axis=1) / in_tile.sum(axis=1)
+    center = ((starts + ends) // 2) * N // length
+    delta = insulation(predictions, w) - insulation(reference[None, :, :], w)
+    return {"mean_abs_diff": np.nanmean(diff, axis=(1, 2)),
+            "tile_abs_diff": tile_abs_diff,
+            "insulation_delta": delta[np.arange(B), center]}
+
+
+def scan(reference, model, starts, ends, operation, batch_size=8, seed=0, device="cpu",
+         predictions_output=None):
+    """
+    Runs the reference and all the mutants through the 1M model
+
+    Returns
+    -------
+    tuple
+        (reference prediction, dict of effect scores)
+    """
+    import torch
+
+    def predict(encodings):
+        with torch.no_grad():
+            pred = pred_1Mb(torch.from_numpy(np.ascontiguousarray(encodings)).float().to(device),
+                            model)
+        return pred.detach().cpu().numpy().reshape(len(encodings), NBINS, NBINS)
+
+    ref_pred = predict(reference[None, :, :])[0]
+    stack = None
+    if predictions_output is not None:
+        stack = np.lib.format.open_memmap(predictions_output, mode="w+", dtype=np.float32,
+                                          shape=(len(starts), NBINS, NBINS))
+    scores = {}
+    for lo, batch in iter_batches(reference, starts, ends, operation, batch_size, seed):
+        preds = predict(batch)
+        hi = lo + len(preds)
+        if stack is not None:
+            stack[lo:hi] = preds
+        for name, values in effect_scores(preds, ref_pred, starts[lo:hi], ends[lo:hi],
+                                          len(reference)).items():
+            scores.setdefault(name, []).append(values)
+        eprint("%d/%d tiles" % (hi, len(starts)))
+    if stack is not None:
+        stack.flush()
+    return ref_pred, {name: np.concatenate(values) for name, values in scores.items()}
+
+
+def main(chrom, start, output_prefix, tile, step=None, operation="mask", batch_size=8,
+         seed=0, keep_predictions=False, use_cuda=True):
+    """
+    Scans the 1Mb window of the hg38 genome starting at chrom:start
+    """
+    import orca_predict
+
+    orca_predict.load_resources(models=['1M'], use_cuda=use_cuda)
+    reference = orca_predict.hg38.get_encoding_from_coords(chrom, start, start + WINDOW)
+    reference = np.asarray(reference, dtype=np.float32)
+
+    starts, ends = tile_bounds(len(reference), tile, step)
+    output = "%s_scan.npy" % output_prefix if keep_predictions else None
+    _, scores = scan(reference, orca_predict.hff_1m, starts, ends, operation, batch_size, seed,
+                     "cuda" if use_cuda else "cpu", output)
+
+    names = list(scores)
+    with open("%s_scan.tsv" % output_prefix, "w") as fout:
+        fout.write("chrom\tstart\tend\toperation\t%s\n" % "\t".join(names))
+        for k in range(len(starts)):
+            fout.write("%s\t%d\t%d\t%s\t%s\n" % (chrom, start + starts[k], start + ends[k],
+                                                 operation,
+                                                 "\t".join("%g" % scores[name][k] for name in names)))
+    with open("%s_scan.bedgraph" % output_prefix, "w") as fout:
+        for k in range(len(starts)):
+            fout.write("%s\t%d\t%d\t%g\n" % (chrom, start + starts[k], start + ends[k],
+                                             scores["tile_abs_diff"][k]))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=textwrap.dedent('''\
+                                     Mutate every tile of a 1Mb window and measure the predicted contact change
+                                     '''))
+    parser.add_argument('--chrom',
+                        required=True, help='chrom name')
+    parser.add_argument('--start', type=int,
+                        required=True, help='start of the 1Mb window')
+    parser.add_argument('--tile', type=int, default=10_000,
+                        required=False, help='tile size in bp (default: 10000)')
+    parser.add_argument('--step', type=int,
+                        required=False, help='distance between tile starts (default: tile size)')
+    parser.add_argument('--operation', default="mask", choices=OPERATIONS,
+                        required=False, help='the mutation applied to each tile (default: mask)')
+    parser.add_argument('--batch', type=int, default=8,
+                        required=False, help='mutants per model call (default: 8)')
+    parser.add_argument('--seed', type=int, default=0,
+                        required=False, help='random seed for shuffle (default: 0)')
+    parser.add_argument('--keep-predictions', action="store_true",
+                        help='write the predicted matrices of every tile (default: False)')
+    parser.add_argument('--outprefix',
+                        required=True, help='the output prefix')
+    parser.add_argument('--nocuda',
+                        action="store_true", help='Switching to cpu (default: False)')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    use_cuda = not args.nocuda
+    main(args.chrom, args.start, args.outprefix, args.tile, args.step, args.operation,
+         args.batch, args.seed, args.keep_predictions, use_cuda)
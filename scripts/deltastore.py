@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import textwrap
+
+import numpy as np
+
+from orcaio import NBINS, RESOLUTIONS, matrix_path, read_matrix
+
+"""
+Compact storage of the predictions of a mutation campaign
+
+The matrices written by dump_target_matrix (6 resolutions x 250 x 250, for
+predictions and normmats) are mostly identical to the wild type away from the
+mutation. A store keeps the reference at full precision (float32) and each
+mutant as its difference with the reference:
+  - the delta of each resolution is quantized to int8 (delta / scale rounded,
+    scale = max |delta| / 127) or stored as float16 (delta / scale, scale =
+    max |delta|), with one scale per resolution
+  - optionally, deltas smaller than a threshold are set to 0 and only the
+    non zero values are stored, with a bit mask of their positions (sparse)
+  - non finite mutant values are stored as exceptions, at full precision
+The maximum reconstruction error of each resolution is measured when the
+mutant is added, stored with it and listed in <store>/index.tsv.
+
+Layout:
+  <store>/reference.npz      reference matrices and headers
+  <store>/mutants/<name>.npz quantized deltas, scales, errors and headers
+  <store>/index.tsv          one line per (mutant, kind, resolution)
+
+>>> store = DeltaStore("campaign_store")
+>>> store.write_reference("wt/chr9")
+>>> store.add("mut/chr9_del_01", dtype="int8", threshold=1e-3)
+>>> stack = store.stack(names, "predictions", "1Mb")     # (B, 250, 250)
+>>> diffs = store.differences(names, "predictions", "1Mb")
+"""
+
+KINDS = ["predictions", "normmats"]
+DTYPES = ["int8", "float16"]
+_QMAX = {"int8": 127, "float16": 1}
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+
+def eprint(*args, **kwargs):
+    print(*args,  file=sys.stderr, **kwargs)
+
+
+def read_matrices(output_prefix, kind="predictions"):
+    """
+    Reads the matrices of all the resolutions of an output prefix
+
+    Returns
+    -------
+    tuple
+        ((6, 250, 250) float32 array, list of header lines)
+    """
+    matrices = np.empty((len(RESOLUTIONS), NBINS, NBINS), dtype=np.float32)
+    headers = []
+    for k, resol in enumerate(RESOLUTIONS):
+        path = matrix_path(output_prefix, resol, kind)
+        with open(path, "r") as fin:
+            headers.append(fin.readline().strip())
+        matrices[k] = read_matrix(path)
+    return matrices, headers
+
+
+def encode_delta(mutant, reference, dtype="int8", threshold=0.0, sparse=False):
+    """
+    Quantizes the difference between mutant and reference matrices
+
+    Parameters
+    ----------
+    mutant, reference: np.ndarray
+        (R, N, N) matrices, one per resolution
+    dtype: str
+        int8 or float16
+    threshold: float
+        absolute deltas smaller or equal to threshold are set to 0
+    sparse: bool
+        store only the non zero quantized values, with a bit mask of their positions
+    Returns
+    -------
+    dict
+        the arrays to save (scale, values, mask, nonfinite, nonfinite_values,
+        error), error being the maximum absolute reconstruction error of each
+        resolution
+    """
+    if dtype not in DTYPES:
+        raise ValueError("%s is not a valid dtype, choose among %s" % (dtype, DTYPES))
+    mutant = np.asarray(mutant, dtype=np.float32)
+    reference = np.asarray(reference, dtype=np.float32)
+    delta = mutant.astype(np.float64) - reference
+    finite = np.isfinite(delta)
+    delta[~finite] = 0
+    if threshold > 0:
+        delta[np.abs(delta) <= threshold] = 0
+
+    scale = np.abs(delta).max(axis=(1, 2)) / _QMAX[dtype]
+    scale[scale == 0] = 1
+    scaled = delta / scale[:, None, None]
+    if dtype == "int8":
+        values = np.clip(np.rint(scaled), -127, 127).astype(np.int8)
+    else:
+        values = scaled.astype(np.float16)
+
+    nonfinite = np.flatnonzero(~finite).astype(np.uint32)
+    encoded = {"scale": scale, "nonfinite": nonfinite,
+               "nonfinite_values": mutant.ravel()[nonfinite]}
+    if sparse:
+        nonzero = values.ravel() != 0
+        encoded.update(mask=np.packbits(nonzero), values=values.ravel()[nonzero])
+    else:
+        encoded["values"] = values
+
+    decoded = decode_delta(encoded, reference)
+    error = np.abs(decoded.astype(np.float64) - mutant)
+    error[~np.isfinite(error)] = 0
+    encoded["error"] = error.max(axis=(1, 2))
+    return encoded
+
+
+def decode_delta(encoded, reference):
+    """
+    Rebuilds the (R, N, N) mutant matrices from encode_delta arrays
+
+    Parameters
+    ----------
+    encoded: dict
+        the arrays returned by encode_delta (or loaded from a store)
+    reference: np.ndarray
+        the (R, N, N) reference matrices
+    """
+    matrices = reference + decode_difference(encoded, reference.shape)
+    nonfinite = np.asarray(encoded["nonfinite"], dtype=np.int64)
+    if len(nonfinite):
+        matrices.ravel()[nonfinite] = encoded["nonfinite_values"]
+    return matrices
+
+
+def decode_difference(encoded, shape):
+    """
+    Rebuilds the (R, N, N) float32 deltas from encode_delta arrays, NaN where
+    the mutant is not finite
+    """
+    scale = np.asarray(encoded["scale"], dtype=np.float32)
+    plane = shape[1] * shape[2]
+    if "mask" in encoded:
+        size = int(np.prod(shape))
+        index = np.flatnonzero(np.unpackbits(encoded["mask"], count=size))
+        delta = np.zeros(size, dtype=np.float32)
+        delta[index] = encoded["values"] * scale[index // plane]
+        delta = delta.reshape(shape)
+    else:
+        delta = encoded["values"] * scale[:, None, None]
+    nonfinite = np.asarray(encoded["nonfinite"], dtype=np.int64)
+    if len(nonfinite):
+        delta = np.array(delta, dtype=np.float32)
+        delta.ravel()[nonfinite] = np.nan
+    return delta
+
+
+class DeltaStore():
+    """
+    Reference matrices and quantized mutant deltas of a campaign
+
+    Parameters
+    ----------
+    directory: str
+        the store directory, created if needed
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, "mutants"), exist_ok=True)
+        self._reference = None
+
+    @property
+    def index(self):
+        return os.path.join(self.directory, "index.tsv")
+
+    def mutant_path(self, name):
+        return os.path.join(self.directory, "mutants", "%s.npz" % name)
+
+    def write_reference(self, output_prefix=None, matrices=None, headers=None):
+        """
+        Stores the reference matrices, from the text files of an output prefix
+        or from dicts kind -> (6, 250, 250) matrices and kind -> header lines
+        """
+        if output_prefix is not None:
+            matrices, headers = {}, {}
+            for kind in KINDS:
+                matrices[kind], headers[kind] = read_matrices(output_prefix, kind)
+        arrays = {}
+        for kind in KINDS:
+            arrays[kind] = np.asarray(matrices[kind], dtype=np.float32)
+            arrays["%s_headers" % kind] = np.array(headers[kind])
+        np.savez(os.path.join(self.directory, "reference.npz"), **arrays)
+        self._reference = None
+
+    def reference(self, kind="predictions"):
+        """Returns the (6, 250, 250) reference matrices"""
+        if self._reference is None:
+            with np.load(os.path.join(self.directory, "reference.npz")) as data:
+                self._reference = {key: data[key] for key in data.files}
+        return self._reference[kind]
+
+    def add(self, output_prefix=None, name=None, dtype="int8", threshold=0.0, sparse=False,
+            matrices=None, headers=None, overwrite=False):
+        """
+        Stores a mutant as quantized deltas against the reference
+
+        Parameters
+        ----------
+        output_prefix: str
+            the output prefix of the mutant text files
+        name: str
+            the mutant name in the store (default: basename of output_prefix)
+        dtype, threshold, sparse:
+            see encode_delta
+        matrices, headers: dict
+            kind -> matrices and header lines, instead of output_prefix
+        overwrite: bool
+            replace a mutant already stored under name; otherwise a
+            FileExistsError is raised, as mutants of different directories may
+            share their basename
+        Returns
+        -------
+        dict
+            kind -> maximum reconstruction error of each resolution
+        """
+        if name is None:
+            if output_prefix is None:
+                raise ValueError("a name is required when the matrices are given")
+            name = os.path.basename(output_prefix)
+        if os.path.exists(self.mutant_path(name)):
+            if not overwrite:
+                raise FileExistsError("a mutant named %s is already stored in %s"
+                                      % (name, self.directory))
+            self._forget(name)
+        if output_prefix is not None:
+            matrices, headers = {}, {}
+            for kind in KINDS:
+                matrices[kind], headers[kind] = read_matrices(output_prefix, kind)
+
+        arrays, errors, stored = {}, {}, {}
+        for kind in KINDS:
+            encoded = encode_delta(matrices[kind], self.reference(kind), dtype, threshold,
+                                   sparse)
+            for key, value in encoded.items():
+                arrays["%s_%s" % (kind, key)] = value
+            arrays["%s_headers" % kind] = np.array(headers[kind])
+            errors[kind] = encoded["error"]
+            nonzero = np.unpackbits(encoded["mask"]) if sparse else encoded["values"] != 0
+            stored[kind] = nonzero[:len(RESOLUTIONS) * NBINS * NBINS].reshape(
+                len(RESOLUTIONS), -1).sum(axis=1)
+        np.savez_compressed(self.mutant_path(name), **arrays)
+
+        new = not os.path.exists(self.index)
+        with open(self.index, "a") as fout:
+            if new:
+                fout.write("name\tkind\tresol\tdtype\tthreshold\tnonzero\tmax_error\n")
+            for kind in KINDS:
+                for k, resol in enumerate(RESOLUTIONS):
+                    fout.write("%s\t%s\t%s\t%s\t%g\t%d\t%g\n" % (name, kind, resol, dtype,
+                                                               threshold, stored[kind][k],
+                                                               errors[kind][k]))
+        return errors
+
+    def _forget(self, name):
+        """Removes the index lines of a mutant"""
+        if not os.path.exists(self.index):
+            return
+        with open(self.index, "r") as fin:
+            lines = fin.readlines()
+        with open(self.index, "w") as fout:
+            fout.writelines(line for k, line in enumerate(lines)
+                            if k == 0 or line.split("\t", 1)[0] != name)
+
+    def _load(self, name, kind):
+        with np.load(self.mutant_path(name)) as data:
+            prefix = "%s_" % kind
+            return {key[len(prefix):]: data[key] for key in data.files if key.startswith(prefix)}
+
+    def read(self, name, kind="predictions"):
+        """
+        Decodes a mutant
+
+        Returns
+        -------
+        tuple
+            ((6, 250, 250) float32 matrices, list of header lines)
+        """
+        encoded = self._load(name, kind)
+        return decode_delta(encoded, self.reference(kind)), list(encoded["headers"])
+
+    def _plane_deltas(self, names, kind, k):
+        """
+        Decodes the deltas of resolution k of several mutants
+
+        Only the entries of plane k are decoded (scale[k], the values of the
+        plane, the mask bits and the exceptions within the plane); the planes
+        of all the mutants are gathered and scaled in one pass.
+
+        Returns
+        -------
+        tuple
+            ((B, N, N) float32 deltas with NaN where the mutant is not finite,
+            flat indices of these pixels in the stack, their mutant values)
+        """
+        plane = NBINS * NBINS
+        lo, hi = k * plane, (k + 1) * plane
+        B = len(names)
+        scales = np.empty(B, dtype=np.float32)
+        dense, sparse_index, sparse_values = [], [], []
+        nonfinite_index, nonfinite_values = [], []
+        for i, name in enumerate(names):
+            with np.load(self.mutant_path(name)) as data:
+                scales[i] = data["%s_scale" % kind][k]
+                if "%s_mask" % kind in data.files:
+                    mask = data["%s_mask" % kind]
+                    # values of the previous planes: set bits before lo
+                    skip = int(_POPCOUNT[mask[:lo // 8]].sum())
+                    bits = np.unpackbits(mask[lo // 8:-(-hi // 8)])
+                    skip += int(bits[:lo % 8].sum())
+                    bits = bits[lo % 8:lo % 8 + plane]
+                    index = np.flatnonzero(bits)
+                    values = data["%s_values" % kind][skip:skip + len(index)]
+                    sparse_index.append(index + i * plane)
+                    sparse_values.append(values.astype(np.float32) * scales[i])
+                else:
+                    dense.append((i, data["%s_values" % kind][k]))
+                nonfinite = data["%s_nonfinite" % kind].astype(np.int64)
+                inside = (nonfinite >= lo) & (nonfinite < hi)
+                nonfinite_index.append(nonfinite[inside] - lo + i * plane)
+                nonfinite_values.append(data["%s_nonfinite_values" % kind][inside])
+
+        deltas = np.zeros((B, NBINS, NBINS), dtype=np.float32)
+        if dense:
+            rows = np.array([i for i, _ in dense])
+            deltas[rows] = np.stack([values for _, values in dense]) * scales[rows, None, None]
+        if sparse_index:
+            deltas.ravel()[np.concatenate(sparse_index)] = np.concatenate(sparse_values)
+        nonfinite_index = np.concatenate(nonfinite_index)
+        deltas.ravel()[nonfinite_index] = np.nan
+        return deltas, nonfinite_index, np.concatenate(nonfinite_values)
+
+    def stack(self, names, kind="predictions", resol="32Mb"):
+        """Decodes the matrices of one resolution of several mutants into a (B, 250, 250) stack"""
+        k = RESOLUTIONS.index(resol)
+        deltas, nonfinite, values = self._plane_deltas(names, kind, k)
+        stack = deltas + self.reference(kind)[k][None, :, :]
+        stack.ravel()[nonfinite] = values
+        return stack
+
+    def differences(self, names, kind="predictions", resol="32Mb"):
+        """
+        Decodes the difference maps (mutant - reference) of one resolution
+        directly from the stored deltas, without adding the reference (NaN
+        where the mutant is not finite)
+        """
+        return self._plane_deltas(names, kind, RESOLUTIONS.index(resol))[0]
+
+    def write_text(self, name, output_prefix):
+        """Writes a stored mutant back as dump_target_matrix text files"""
+        for kind in KINDS:
+            matrices, headers = self.read(name, kind)
+            for matrix, header, resol in zip(matrices, headers, RESOLUTIONS):
+                np.savetxt(matrix_path(output_prefix, resol, kind), matrix, delimiter='\t',
+                           header=header, comments='')
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=textwrap.dedent('''\
+                                     Store mutant predictions as quantized deltas against the wild type
+                                     '''))
+    parser.add_argument('--store',
+                        required=True, help='the store directory')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    reference = subparsers.add_parser("reference", help="store the wild type prediction")
+    reference.add_argument('--prefix',
+                           required=True, help='the output prefix of the wild type prediction')
+
+    add = subparsers.add_parser("add", help="store mutant predictions")
+    add.add_argument('--mutants',
+                     required=True, help='a file listing the output prefixes of the mutants, one per line')
+    add.add_argument('--dtype', default="int8", choices=DTYPES,
+                     required=False, help='the quantization of the deltas (default: int8)')
+    add.add_argument('--threshold', type=float, default=0.0,
+                     required=False, help='deltas smaller than threshold are set to 0 (default: 0)')
+    add.add_argument('--sparse', action="store_true",
+                     help='store only the non zero deltas (default: False)')
+    add.add_argument('--overwrite', action="store_true",
+                     help='replace the mutants already stored under the same name (default: False)')
+
+    decode = subparsers.add_parser("decode", help="write a stored mutant back as text files")
+    decode.add_argument('--name',
+                        required=True, help='the mutant name in the store')
+    decode.add_argument('--outprefix',
+                        required=True, help='the output prefix')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    store = DeltaStore(args.store)
+    if args.command == "reference":
+        store.write_reference(args.prefix)
+    elif args.command == "add":
+        with open(args.mutants, "r") as fin:
+            prefixes = [line.strip() for line in fin if line.strip() and not line.startswith("#")]
+        worst = 0.0
+        for prefix in prefixes:
+            errors = store.add(prefix, dtype=args.dtype, threshold=args.threshold,
+                               sparse=args.sparse, overwrite=args.overwrite)
+            worst = max(worst, max(float(error.max()) for error in errors.values()))
+        eprint("%d mutants stored, max reconstruction error %g, store size %d bytes" %
+               (len(prefixes), worst, directory_size(args.store)))
+    elif args.command == "decode":
+        store.write_text(args.name, args.outprefix)
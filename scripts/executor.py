@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor,
+                                wait)
+from concurrent.futures.process import BrokenProcessPool
+
+from intervals import read_chromsizes
+
+"""
+Memory-aware parallel execution of per-chromosome and per-genome scans
+
+Extends the futures_collector of ParallelPython.md:
+  - cpu bound tasks (pure python scans) run in processes, io bound tasks in threads
+  - each task comes with an estimate of its memory footprint (for example from
+    the chromosome lengths of the .fai index) and tasks are only started while
+    the estimates of the running tasks fit in the memory budget
+  - results are yielded as soon as tasks complete
+  - a task failing with MemoryError, or killed with its worker process (OOM
+    killer), is retried with a halved concurrency
+
+>>> for chrom, count in scan_genome(count_nucleotides, "hg38.fa", memory=0.5):
+...     print(chrom, count)
+"""
+
+KINDS = ["cpu", "io"]
+
+
+def eprint(*args, **kwargs):
+    print(*args,  file=sys.stderr, **kwargs)
+
+
+def available_memory():
+    """Returns the available memory in bytes (MemAvailable on Linux)"""
+    try:
+        with open("/proc/meminfo", "r") as fin:
+            for line in fin:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+
+def memory_budget(memory):
+    """Converts a ratio of the available memory, ranging from .05 to .95, into bytes"""
+    if not 0.05 <= memory <= 0.95:
+        raise ValueError("memory ratio %s must range from .05 to .95" % memory)
+    return int(available_memory() * memory)
+
+
+def fai_estimates(fai, chromosomes=None, bytes_per_base=2.0, overhead=50 * 2**20):
+    """
+    Estimates the memory of a per-chromosome task from the .fai lengths
+
+    Parameters
+    ----------
+    fai: str
+        the fasta index
+    chromosomes: list
+        the chromosomes to keep (default: all)
+    bytes_per_base: float
+        memory used per base, 2 accounts for a python string of the chromosome
+        plus a copy
+    overhead: int
+        fixed memory of a task (interpreter, imports) in bytes
+    Returns
+    -------
+    dict
+        chromosome -> estimated bytes
+    """
+    chromsizes = read_chromsizes(fai)
+    if chromosomes is None:
+        chromosomes = list(chromsizes)
+    return {chrom: int(chromsizes[chrom] * bytes_per_base) + overhead for chrom in chromosomes}
+
+
+def _executor(kind, workers):
+    if kind == "cpu":
+        return ProcessPoolExecutor(max_workers=workers)
+    if kind == "io":
+        return ThreadPoolExecutor(max_workers=workers)
+    raise ValueError("%s is not a valid task kind, choose among %s" % (kind, KINDS))
+
+
+def iter_results(func, argslist, kwargslist=None, estimates=None, kind="cpu",
+                 num_processes=None, memory=None, retries=2):
+    """
+    Runs func on each element of argslist and yields (index, result) as tasks complete
+
+    Parameters
+    ----------
+    func: callable
+        the task, it must be picklable (module level function) if kind is cpu
+    argslist: list
+        a list of tuples, positional arguments of each task
+    kwargslist: list
+        a list of dicts, keyword arguments of each task
+    estimates: list
+        estimated memory in bytes of each task (default: 0)
+    kind: str
+        cpu (processes) or io (threads)
+    num_processes: int
+        max number of concurrent tasks (default: number of cpus)
+    memory: float
+        ratio of the available memory to use, ranging from .05 to .95; a task
+        larger than the budget still runs, alone
+    retries: int
+        number of retries of a task failing with a memory error; when a worker
+        process dies, the tasks sharing its pool are retried without being
+        charged, the concurrency is halved until the task runs alone
+    """
+    if kwargslist is not None and len(kwargslist) != len(argslist):
+        raise ValueError("Positionnal argument list length (%d) does not match keywords "
+                         "argument list length (%d)." % (len(argslist), len(kwargslist)))
+    count = len(argslist)
+    argslist = [args if isinstance(args, (tuple, list)) else (args,) for args in argslist]
+    kwargslist = kwargslist or [{}] * count
+    estimates = estimates or [0] * count
+    budget = memory_budget(memory) if memory is not None else None
+    workers = num_processes or os.cpu_count()
+
+    pending = deque(range(count))
+    attempts = [0] * count
+    running = {}
+    used = 0
+    executor = _executor(kind, workers)
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                # the first pending task fitting in the remaining budget (any
+                # task when nothing runs), so that small tasks fill the budget
+                # left by large ones
+                if budget is None or not running:
+                    index = pending[0]
+                else:
+                    index = next((i for i in pending if used + estimates[i] <= budget), None)
+                    if index is None:
+                        break
+                pending.remove(index)
+                future = executor.submit(func, *argslist[index], **kwargslist[index])
+                running[future] = index
+                used += estimates[index]
+
+            in_pool = len(running)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            failed, broken = False, False
+            for future in done:
+                index = running.pop(future)
+                used -= estimates[index]
+                try:
+                    result = future.result()
+                except (MemoryError, BrokenProcessPool) as error:
+                    # a broken pool fails all its tasks: the culprit is only
+                    # known, and charged an attempt, when it ran alone
+                    if isinstance(error, MemoryError) or in_pool == 1:
+                        attempts[index] += 1
+                        if attempts[index] > retries:
+                            raise
+                    failed = True
+                    broken |= isinstance(error, BrokenProcessPool)
+                    eprint("Task %d failed with %s" % (index, type(error).__name__))
+                    pending.appendleft(index)
+                    continue
+                yield index, result
+
+            if failed:
+                workers = max(1, workers // 2)
+                eprint("Retrying with %d workers" % workers)
+
+            if broken:
+                # the pool is unusable: the other running tasks are lost too
+                for future, index in running.items():
+                    pending.appendleft(index)
+                running, used = {}, 0
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = _executor(kind, workers)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def futures_collector(func, argslist, kwargslist=None, num_processes=None, memory=None,
+                      estimates=None, kind="cpu", retries=2):
+    """
+    Runs func on each element of argslist, see iter_results
+
+    Returns
+    -------
+    list
+        the results in the order of argslist
+    """
+    results = [None] * len(argslist)
+    for index, result in iter_results(func, argslist, kwargslist, estimates, kind,
+                                       num_processes, memory, retries):
+        results[index] = result
+    return results
+
+
+def scan_genome(func, genome, chromosomes=None, kind="cpu", num_processes=None, memory=None,
+                bytes_per_base=2.0, retries=2, **kwargs):
+    """
+    Runs func(genome, chrom, **kwargs) for each chromosome and yields (chrom, result)
+    as tasks complete; the memory of each task is estimated from genome.fai
+
+    Parameters
+    ----------
+    func: callable
+        the per-chromosome scan
+    genome: str
+        the fasta file, indexed
+    chromosomes: list
+        the chromosomes to scan (default: all the chromosomes of the index)
+    """
+    estimates = fai_estimates(genome + ".fai", chromosomes, bytes_per_base)
+    chromosomes = list(estimates)
+    # the largest chromosomes first, so that small ones fill the remaining budget
+    chromosomes.sort(key=lambda chrom: estimates[chrom], reverse=True)
+    argslist = [(genome, chrom) for chrom in chromosomes]
+    for index, result in iter_results(func, argslist, [kwargs] * len(argslist),
+                                      [estimates[chrom] for chrom in chromosomes], kind,
+                                      num_processes, memory, retries):
+        yield chromosomes[index], result
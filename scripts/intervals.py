@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import sys
+import textwrap
+
+import numpy as np
+
+"""
+Interval algebra on per-chromosome sorted start/end arrays
+
+Intervals are stored, for each chromosome, as two int64 numpy arrays (starts
+and ends, 0-based half open as in bed files). All the operations are
+vectorized (sorting, cumulative sums and searchsorted) so that genome-wide
+feature sets (rmsk repeats, fimo sites, ENCODE peaks) can be combined without
+python loops or bedtools calls.
+
+The results can be written directly in the 7 columns mutation format read by
+mutate.py (read_mutations):
+
+chr start end sequence id strand type
+"""
+
+MUTATION_TYPES = ["shuffle", "inversion", "mask"]
+
+
+def eprint(*args, **kwargs):
+    print(*args,  file=sys.stderr, **kwargs)
+
+
+def _empty():
+    return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+
+def sort_intervals(starts, ends):
+    """Returns the intervals sorted by start then end"""
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    order = np.lexsort((ends, starts))
+    return starts[order], ends[order]
+
+
+def merge(starts, ends, distance=0):
+    """
+    Merges overlapping or book-ended intervals, equivalent to bedtools merge
+
+    Parameters
+    ----------
+    starts, ends: np.ndarray
+        the intervals of one chromosome (not necessarily sorted)
+    distance: int
+        maximum distance between intervals allowed for them to be merged
+    Returns
+    -------
+    tuple
+        the sorted, non overlapping (starts, ends) arrays
+    """
+    if len(starts) == 0:
+        return _empty()
+    starts, ends = sort_intervals(starts, ends)
+    # running maximum of the ends: an interval opens a new group when it
+    # starts after every previous interval has ended
+    reach = np.maximum.accumulate(ends)
+    new_group = np.empty(len(starts), dtype=bool)
+    new_group[0] = True
+    new_group[1:] = starts[1:] > reach[:-1] + distance
+    first = np.flatnonzero(new_group)
+    last = np.append(first[1:] - 1, len(starts) - 1)
+    return starts[first], reach[last]
+
+
+def complement(starts, ends, chromlen):
+    """
+    Constructs the complement of the intervals in [0, chromlen),
+    equivalent to bedtools complement
+    """
+    # empty intervals (start == end) cover nothing and must not split the complement
+    keep = ends > starts
+    starts, ends = merge(starts[keep], ends[keep])
+    comp_starts = np.concatenate(([0], ends)).astype(np.int64)
+    comp_ends = np.concatenate((starts, [chromlen])).astype(np.int64)
+    keep = comp_ends > comp_starts
+    return comp_starts[keep], comp_ends[keep]
+
+
+def _sweep(a_starts, a_ends, b_starts, b_ends):
+    """
+    Sweeps the boundaries of two interval sets
+
+    Returns the elementary segments delimited by all the boundaries, with the
+    number of intervals of each set covering them
+    """
+    positions = np.concatenate((a_starts, a_ends, b_starts, b_ends)).astype(np.int64)
+    if len(positions) == 0:
+        return _empty() + _empty()
+    a_delta = np.concatenate((np.ones(len(a_starts)), -np.ones(len(a_ends)),
+                              np.zeros(len(b_starts) + len(b_ends)))).astype(np.int64)
+    b_delta = np.concatenate((np.zeros(len(a_starts) + len(a_ends)),
+                              np.ones(len(b_starts)), -np.ones(len(b_ends)))).astype(np.int64)
+    order = np.argsort(positions, kind="stable")
+    positions = positions[order]
+    a_depth = np.cumsum(a_delta[order])
+    b_depth = np.cumsum(b_delta[order])
+    # the depth after the last event at a given position holds up to the next
+    # position
+    last = np.append(positions[1:] != positions[:-1], True)
+    positions = positions[last]
+    return positions[:-1], positions[1:], a_depth[last][:-1], b_depth[last][:-1]
+
+
+def _join(seg_starts, seg_ends, keep):
+    """Merges the adjacent kept segments returned by _sweep"""
+    if not keep.any():
+        return _empty()
+    return merge(seg_starts[keep], seg_ends[keep])
+
+
+def intersect(a_starts, a_ends, b_starts, b_ends):
+    """
+    Returns the portions of a covered by b, equivalent to bedtools intersect
+    (followed by a merge)
+    """
+    seg_starts, seg_ends, a_depth, b_depth = _sweep(a_starts, a_ends, b_starts, b_ends)
+    return _join(seg_starts, seg_ends, (a_depth > 0) & (b_depth > 0))
+
+
+def subtract(a_starts, a_ends, b_starts, b_ends):
+    """
+    Returns the portions of a not covered by b, equivalent to bedtools subtract
+    (followed by a merge)
+    """
+    seg_starts, seg_ends, a_depth, b_depth = _sweep(a_starts, a_ends, b_starts, b_ends)
+    return _join(seg_starts, seg_ends, (a_depth > 0) & (b_depth == 0))
+
+
+def slop(starts, ends, chromlen, left=0, right=0):
+    """
+    Extends the intervals by left and right bp, clipped to the chromosome,
+    equivalent to bedtools slop -l left -r right
+    """
+    starts = np.clip(np.asarray(starts, dtype=np.int64) - left, 0, chromlen)
+    ends = np.clip(np.asarray(ends, dtype=np.int64) + right, 0, chromlen)
+    return starts, ends
+
+
+def window(a_starts, a_ends, b_starts, b_ends, distance=1000):
+    """
+    Returns the intervals of a having at least one interval of b within
+    distance bp, equivalent to bedtools window -w distance -u
+
+    Parameters
+    ----------
+    a_starts, a_ends: np.ndarray
+        the query intervals
+    b_starts, b_ends: np.ndarray
+        the feature intervals
+    distance: int
+        the window size added on both sides of each query interval
+    Returns
+    -------
+    tuple
+        the sorted (starts, ends) arrays of the selected query intervals
+    """
+    a_starts, a_ends = sort_intervals(a_starts, a_ends)
+    b_starts, b_ends = merge(b_starts, b_ends)
+    # b is non overlapping hence both its starts and ends are sorted
+    before_end = np.searchsorted(b_starts, a_ends + distance, side="left")
+    ended_before = np.searchsorted(b_ends, a_starts - distance, side="right")
+    keep = before_end > ended_before
+    return a_starts[keep], a_ends[keep]
+
+
+class IntervalSet():
+    """
+    Genome-wide set of intervals stored as per-chromosome sorted arrays
+
+    Parameters
+    ----------
+    intervals: dict
+        chromosome name -> (starts, ends) tuple of arrays
+    Attributes
+    ----------
+    intervals: dict
+        chromosome name -> (starts, ends), sorted by start
+    """
+    def __init__(self, intervals=None):
+        self.intervals = {}
+        for chrom, (starts, ends) in (intervals or {}).items():
+            self.intervals[chrom] = sort_intervals(starts, ends)
+
+    @classmethod
+    def from_arrays(cls, chroms, starts, ends):
+        """Builds a set from three parallel columns"""
+        chroms = np.asarray(chroms)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        intervals = {}
+        if len(chroms):
+            names, codes = np.unique(chroms, return_inverse=True)
+            order = np.argsort(codes, kind="stable")
+            bounds = np.searchsorted(codes[order], np.arange(len(names) + 1))
+            for i, chrom in enumerate(names):
+                idx = order[bounds[i]:bounds[i+1]]
+                intervals[str(chrom)] = (starts[idx], ends[idx])
+        return cls(intervals)
+
+    @classmethod
+    def from_mutations(cls, mutations):
+        """Builds a set from a list of mutate.Mutation"""
+        return cls.from_arrays([m.chrom for m in mutations],
+                               [m.start for m in mutations],
+                               [m.end for m in mutations])
+
+    @property
+    def chromosomes(self):
+        return list(self.intervals.keys())
+
+    def __len__(self):
+        return sum(len(starts) for starts, _ in self.intervals.values())
+
+    def get(self, chrom):
+        """Returns the (starts, ends) arrays of a chromosome"""
+        return self.intervals.get(chrom, _empty())
+
+    def _apply(self, func, chroms, *args, **kwargs):
+        result = {}
+        for chrom in chroms:
+            starts, ends = func(chrom, *args, **kwargs)
+            if len(starts):
+                result[chrom] = (starts, ends)
+        return IntervalSet(result)
+
+    def merge(self, distance=0):
+        return self._apply(lambda c: merge(*self.get(c), distance=distance), self.chromosomes)
+
+    def complement(self, chromsizes):
+        """chromsizes: dict chromosome name -> length, see read_chromsizes"""
+        return self._apply(lambda c: complement(*self.get(c), chromsizes[c]), chromsizes)
+
+    def intersect(self, other):
+        return self._apply(lambda c: intersect(*self.get(c), *other.get(c)), self.chromosomes)
+
+    def subtract(self, other):
+        return self._apply(lambda c: subtract(*self.get(c), *other.get(c)), self.chromosomes)
+
+    def slop(self, chromsizes, left=0, right=0):
+        return self._apply(lambda c: slop(*self.get(c), chromsizes[c], left, right),
+                           self.chromosomes)
+
+    def window(self, other, distance=1000):
+        return self._apply(lambda c: window(*self.get(c), *other.get(c), distance=distance),
+                           self.chromosomes)
+
+    def to_mutations(self, operation, prefix=None, strand="+"):
+        """
+        Yields the intervals as lines of the 7 columns mutation format
+
+        Parameters
+        ----------
+        operation: str
+            the mutation applied to every interval, among shuffle, inversion and mask
+            (insertions require a sequence and are not generated here)
+        prefix: str
+            prefix of the mutation identifiers (default: the operation),
+            identifiers are numbered from 1 as in data/mutations.bed
+        strand: str
+            the strand column
+        """
+        if operation not in MUTATION_TYPES:
+            raise ValueError("%s is not a valid operation" % operation)
+        prefix = operation if prefix is None else prefix
+        num = 0
+        for chrom, (starts, ends) in self.intervals.items():
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                num += 1
+                yield "%s\t%d\t%d\t.\t%s%d\t%s\t%s\n" % (chrom, start, end, prefix,
+                                                          num, strand, operation)
+
+    def write_mutations(self, output, operation, prefix=None, strand="+"):
+        with open(output, "w") as fout:
+            fout.writelines(self.to_mutations(operation, prefix, strand))
+
+    def write_bed(self, output):
+        with open(output, "w") as fout:
+            for chrom, (starts, ends) in self.intervals.items():
+                for start, end in zip(starts.tolist(), ends.tolist()):
+                    fout.write("%s\t%d\t%d\n" % (chrom, start, end))
+
+
+def read_bed(bedfile):
+    """Reads the first three columns of a bed file into an IntervalSet"""
+    chroms, starts, ends = [], [], []
+    with open(bedfile, "r") as fin:
+        for line in fin:
+            if line.startswith(("#", "track", "browser")) or not line.strip():
+                continue
+            fields = line.split(None, 3)
+            chroms.append(fields[0])
+            starts.append(fields[1])
+            ends.append(fields[2])
+    return IntervalSet.from_arrays(chroms, np.asarray(starts, dtype=np.int64),
+                                   np.asarray(ends, dtype=np.int64))
+
+
+def read_chromsizes(fai):
+    """Reads chromosome lengths from a fasta index (.fai) or a chrom.sizes file"""
+    chromsizes = {}
+    with open(fai, "r") as fin:
+        for line in fin:
+            fields = line.split()
+            chromsizes[fields[0]] = int(fields[1])
+    return chromsizes
+
+
+def main(bedfile, operation, output, mutation, other=None, genome=None,
+         distance=None, left=0, right=0, prefix=None):
+    intervals = read_bed(bedfile)
+    others = read_bed(other) if other else None
+    chromsizes = read_chromsizes(genome) if genome else None
+
+    if operation in ["intersect", "subtract", "window"] and others is None:
+        raise ValueError("operation %s requires --other" % operation)
+    if operation in ["complement", "slop"] and chromsizes is None:
+        raise ValueError("operation %s requires --genome" % operation)
+
+    if operation == "merge":
+        result = intervals.merge(0 if distance is None else distance)
+    elif operation == "complement":
+        result = intervals.complement(chromsizes)
+    elif operation == "intersect":
+        result = intervals.intersect(others)
+    elif operation == "subtract":
+        result = intervals.subtract(others)
+    elif operation == "slop":
+        result = intervals.slop(chromsizes, left, right)
+    elif operation == "window":
+        result = intervals.window(others, 1000 if distance is None else distance)
+    else:
+        raise ValueError("%s is not a valid interval operation" % operation)
+
+    # mutations must not overlap
+    result = result.merge()
+    result.write_mutations(output, mutation, prefix)
+    eprint("%d mutations written to %s" % (len(result), output))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=textwrap.dedent('''\
+                                     Combine bed intervals and write them as a mutation file for mutate.py
+                                     '''))
+    parser.add_argument('--bed',
+                        required=True, help='the input bed file')
+    parser.add_argument('--operation',
+                        required=True,
+                        choices=["merge", "complement", "intersect", "subtract", "slop", "window"],
+                        help='the interval operation')
+    parser.add_argument('--other',
+                        required=False, help='the second bed file (intersect, subtract, window)')
+    parser.add_argument('--genome',
+                        required=False, help='the fasta index or chrom sizes file (complement, slop)')
+    parser.add_argument('--distance', type=int,
+                        required=False, help='merge or window distance (default: 0 for merge, '
+                        '1000 for window)')
+    parser.add_argument('--left', type=int, default=0,
+                        required=False, help='slop on the left side (default: 0)')
+    parser.add_argument('--right', type=int, default=0,
+                        required=False, help='slop on the right side (default: 0)')
+    parser.add_argument('--mutation',
+                        required=True, choices=MUTATION_TYPES, help='the mutation type')
+    parser.add_argument('--prefix',
+                        required=False, help='prefix of the mutation ids (default: mutation type)')
+    parser.add_argument('--output',
+                        required=True, help='the output mutation file')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    main(args.bed, args.operation, args.output, args.mutation, args.other, args.genome,
+         args.distance, args.left, args.right, args.prefix)
@@ -16,6 +16,8 @@ from Bio.Seq import Seq
 from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
 
+from intervals import IntervalSet, complement
+
 """
 In silico mutation of a sequence specified by a vcf-like file
 
@@ -70,6 +72,8 @@ class Mutator():
         the list of chromosome names (unused)
     intervals: list
         the list of BedIntervals
+    intervalset: :obj:`intervals.IntervalSet`
+        the mutated intervals grouped by chromosome as sorted arrays
     cachedSequences: dict
         the chromosomes sequences stored in a dictionnary
     chromosome_mutations: dict
@@ -80,6 +84,7 @@ class Mutator():
         self.maximumCached = maximumCached
         self.references = fasta_handle.references
         self.intervals = intervals
+        self.intervalset = IntervalSet.from_mutations(intervals)
         self.cachedSequences = {}
         self.chromosome_mutations = defaultdict(int)
 
@@ -166,15 +171,9 @@ class Mutator():
         Constructs the complement of the intervals for a given chromosome
         Equivalent to bedtools complement
         """
-        chrom_intervals = [inter for inter in self.intervals if inter.chrom == chrom]
         chrom_len = len(self.fetch(chrom))
-        intervals = []
-        previous = 0
-        for inter in sorted(chrom_intervals, key=lambda x: x.start):
-            intervals.append([previous, inter.start])
-            previous = inter.end
-        intervals.append([previous, chrom_len])
-        return intervals
+        starts, ends = complement(*self.intervalset.get(chrom), chrom_len)
+        return [[start, end] for start, end in zip(starts.tolist(), ends.tolist())]
 
     def get_concatenated_seq(self, intervals, seq):
         """
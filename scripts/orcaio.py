@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+
+import numpy as np
+
+"""
+Reading of the matrices written by dump_target_matrix (process_sequence.py
+and process_sequence_1Mb.py)
+
+Each matrix is a tab delimited text file whose first line is a header such as
+
+# Orca=predictions resol=32Mb mpos=16000000 wpos=16000000 chrom=chr9 start=0 end=32000000 ...
+
+Files of one output prefix are named <prefix>_predictions_<resol>.txt and
+<prefix>_normmats_<resol>.txt
+"""
+
+RESOLUTIONS = ["%dMb" % r for r in [32, 16, 8, 4, 2, 1]]
+NBINS = 250
+
+_FIELD = re.compile(r"(\w+)=([^\s,]+)")
+
+
+def matrix_path(output_prefix, resol, kind="predictions"):
+    """Returns the path of a matrix written by dump_target_matrix"""
+    return "%s_%s_%s.txt" % (output_prefix, kind, resol)
+
+
+def parse_header(line):
+    """
+    Parses a matrix header into a dictionnary, integer fields are converted
+    """
+    header = {}
+    for key, value in _FIELD.findall(line):
+        try:
+            header[key] = int(value)
+        except ValueError:
+            header[key] = value
+    return header
+
+
+def read_header(path):
+    """Reads only the header line of a matrix file"""
+    with open(path, "r") as fin:
+        return parse_header(fin.readline())
+
+
+def read_matrix(path):
+    """Reads a matrix file written by dump_target_matrix"""
+    return np.loadtxt(path, comments="#", delimiter="\t")
+
+
+def mutation_bin(header):
+    """
+    Returns the bin index of the mutation recorded in a header, or None
+
+    The mutation field is the coordinate of the mutation, in the frame of the
+    start and end fields (as given to process_sequence.py --mutation); None is
+    returned when it is missing or outside [start, end)
+    """
+    mutation = header.get("mutation")
+    start, end = header.get("start"), header.get("end")
+    if not all(isinstance(value, int) for value in [mutation, start, end]):
+        return None
+    if not start <= mutation < end:
+        return None
+    return (mutation - start) * header.get("nbins", NBINS) // (end - start)
+
+
+def mutation_position(header):
+    """
+    Returns the coordinate of the mutation recorded in a header, or None
+
+    The coordinate is returned even when it lies outside the window of the
+    matrix (the matrix is still the one of a mutated sequence), see mutation_bin
+    """
+    mutation = header.get("mutation")
+    return mutation if isinstance(mutation, int) else None
+
+
+def load_stack(paths, cache=None, nbins=NBINS):
+    """
+    Loads a list of matrices into a (B, nbins, nbins) float32 stack
+
+    Parameters
+    ----------
+    paths: list
+        the matrix files
+    cache: str
+        optional .npy file; the stack is written there once, with the list of
+        its matrices in <cache>.paths, and memory-mapped by the following calls
+        as long as the paths, their order and their mtimes are unchanged
+    nbins: int
+        the size of the matrices
+    Returns
+    -------
+    np.ndarray or np.memmap
+        the stacked matrices in the order of paths
+    """
+    shape = (len(paths), nbins, nbins)
+    if cache is None:
+        stack = np.empty(shape, dtype=np.float32)
+        for i, path in enumerate(paths):
+            stack[i] = read_matrix(path)
+        return stack
+
+    # the ordered paths and their mtimes are kept next to the cache, which is
+    # rebuilt as soon as the list, its order or a matrix changes
+    key = "".join("%s\t%r\n" % (os.path.abspath(path), os.path.getmtime(path))
+                  for path in paths)
+    key_path = "%s.paths" % cache
+    if os.path.exists(cache) and os.path.exists(key_path):
+        with open(key_path, "r") as fin:
+            if fin.read() == key:
+                stack = np.load(cache, mmap_mode="r")
+                if stack.shape == shape:
+                    return stack
+
+    stack = np.lib.format.open_memmap(cache, mode="w+", dtype=np.float32, shape=shape)
+    for i, path in enumerate(paths):
+        stack[i] = read_matrix(path)
+    stack.flush()
+    del stack
+    with open(key_path, "w") as fout:
+        fout.write(key)
+    return np.load(cache, mmap_mode="r")
@@ -2,15 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import os
 import re
 import textwrap
 import pickle
 import numpy as np
-from pyfaidx import Fasta
-
-import orca_predict
-from orca_utils import genomeplot
-from selene_sdk.sequences import Genome
 
 H1_ESC = 0
 HFF = 1
@@ -25,6 +21,7 @@ def set_mpos(mpos):
 
 def get_sequence(fasta, chrom):
     """ Using pysam Fasta to retrieve the sequence"""
+    from pyfaidx import Fasta
     genome = Fasta(fasta)
     sequence = str(genome[chrom][:])
     # Check that the sequence is a 32Mb sequence
@@ -34,27 +31,44 @@ def get_sequence(fasta, chrom):
     return sequence
 
 
-def dump_target_matrix(predict, output_prefix, mpos, wpos, mutation, chrom, chromlen):
-
+def dump_target_matrix(predict, output_prefix, mpos, wpos, mutation, chrom, chromlen,
+                       store=None, reference=False):
+    """
+    Writes the Hff matrices as text files, or in a deltastore.DeltaStore if
+    store is given (as the reference, or as a mutant named after the basename
+    of the prefix; DeltaStore.add refuses to overwrite a mutant of the same name)
+    """
     resolutions = ["%dMb" % r for r in [32, 16, 8, 4, 2, 1]]
 
     # Hff is the second prediction hence 1 in 0-based
     hff_predictions = predict['predictions'][1]
     starts = predict['start_coords']
     ends = predict['end_coords']
-    for pred, resol, start, end in zip(hff_predictions, resolutions, starts, ends):
-        output = "%s_predictions_%s.txt" % (output_prefix, resol)
-        header = ("# Orca=predictions resol=%s mpos=%d wpos=%d chrom=%s start=%d end=%d "
-                  "nbins=250 width=%d chromlen=%d mutation=%s" %
-                  (resol, mpos, wpos, chrom,  start, end, end-start, chromlen, mutation))
-        np.savetxt(output, pred, delimiter='\t', header=header, comments='')
+    headers = {"predictions": [], "normmats": []}
+    for resol, start, end in zip(resolutions, starts, ends):
+        headers["predictions"].append(
+            "# Orca=predictions resol=%s mpos=%d wpos=%d chrom=%s start=%d end=%d "
+            "nbins=250 width=%d chromlen=%d mutation=%s" %
+            (resol, mpos, wpos, chrom,  start, end, end-start, chromlen, mutation))
+        headers["normmats"].append(
+            "# Orca=normmats resol=%s mpos=%s wpos=%d chrom=%s  start=%d end=%d "
+            "nbins=250 width=%d chromlen=%d mutation=%s" %
+            (resol, mpos, wpos, chrom, start, end, end-start, chromlen, mutation))
     hff_normmats = predict['normmats'][1]
-    for pred, resol, start, end in zip(hff_normmats, resolutions, starts, ends):
-        output = "%s_normmats_%s.txt" % (output_prefix, resol)
-        header = ("# Orca=normmats resol=%s mpos=%s wpos=%d chrom=%s  start=%d end=%d "
-                  "nbins=250 width=%d chromlen=%d mutation=%s" %
-                  (resol, mpos, wpos, chrom, start, end, end-start, chromlen, mutation))
-        np.savetxt(output, pred, delimiter='\t', header=header, comments='')
+
+    if store is not None:
+        from deltastore import DeltaStore
+        matrices = {"predictions": np.stack(hff_predictions), "normmats": np.stack(hff_normmats)}
+        if reference:
+            DeltaStore(store).write_reference(matrices=matrices, headers=headers)
+        else:
+            DeltaStore(store).add(name=os.path.basename(output_prefix), matrices=matrices,
+                                  headers=headers)
+    else:
+        for kind, matrices in [("predictions", hff_predictions), ("normmats", hff_normmats)]:
+            for pred, resol, header in zip(matrices, resolutions, headers[kind]):
+                output = "%s_%s_%s.txt" % (output_prefix, kind, resol)
+                np.savetxt(output, pred, delimiter='\t', header=header, comments='')
 
     outputlog = "%s.log" % output_prefix
     with open(outputlog, "w") as fout:
@@ -63,9 +77,16 @@ def dump_target_matrix(predict, output_prefix, mpos, wpos, mutation, chrom, chro
             fout.write("%s\t%s\t%d\t%d\n" % (resol, chrom, start, end))
 
 
-def main(fasta, chrom, output_prefix, mutation, mpos=-1, use_cuda=True):
+def main(fasta, chrom, output_prefix, mutation, mpos=-1, use_cuda=True, store=None,
+         reference=False):
     """
     """
+    # orca, selene and matplotlib (genomeplot) are imported here, not at module
+    # level, so that --help and argument errors do not pay their startup time
+    import orca_predict
+    from orca_utils import genomeplot
+    from selene_sdk.sequences import Genome
+
     sequence = get_sequence(fasta, chrom)
 
     orca_predict.load_resources(models=['32M', '256M'], use_cuda=use_cuda)
@@ -78,11 +99,14 @@ def main(fasta, chrom, output_prefix, mutation, mpos=-1, use_cuda=True):
                                              mpos=mpos, wpos=midpoint,
                                              use_cuda=use_cuda)
 
-    output_pkl = "%s.pkl" % output_prefix
-    file = open(output_pkl, 'wb')
-    pickle.dump(outputs_ref, file)
+    if store is None:
+        # in --store mode only the compact deltas are kept
+        output_pkl = "%s.pkl" % output_prefix
+        with open(output_pkl, 'wb') as file:
+            pickle.dump(outputs_ref, file)
     chromlen = 158534110
-    dump_target_matrix(outputs_ref, output_prefix, mpos, wpos, mutation, chrom, chromlen)
+    dump_target_matrix(outputs_ref, output_prefix, mpos, wpos, mutation, chrom, chromlen,
+                       store, reference)
 
     model_labels = ["H1-ESC", "HFF"]
     genomeplot(
@@ -110,7 +134,14 @@ def parse_arguments():
                         required=False, help='The coordinate to zoom into for multiscale prediction.',
                         default=-1,  type=int)
     parser.add_argument('--mutation',
-                        required=False, help='The coordinate of the mutated bin.')
+                        required=False, help='The coordinate of the mutation, in the frame of '
+                        'the matrix start and end (recorded as mutation= in the headers).')
+    parser.add_argument('--store',
+                        required=False, help='store the matrices as deltas in this directory '
+                        'instead of text files and the .pkl (see deltastore.py)')
+    parser.add_argument('--reference',
+                        action="store_true", help='with --store, store the matrices as the '
+                        'reference of the campaign (default: False)')
     parser.add_argument('--nocuda',
                         action="store_true", help='Switching to cpu (default: False)')
 
@@ -122,4 +153,5 @@ if __name__ == '__main__':
     args = parse_arguments()
 
     use_cuda = not args.nocuda
-    main(args.fasta, args.chrom, args.outprefix, args.mutation, args.mpos, use_cuda)
+    main(args.fasta, args.chrom, args.outprefix, args.mutation, args.mpos, use_cuda, args.store,
+         args.reference)
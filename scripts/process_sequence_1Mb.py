@@ -5,9 +5,6 @@ import argparse
 import textwrap
 import numpy as np
 
-import orca_predict
-from orca_predict import *
-
 
 def pred_1Mb(seq, model):
     """
@@ -42,6 +39,11 @@ def main(chrom, start, output_prefix, use_cuda=True):
     """
     Extracts a 1Mb sequence from the hg38 genome, with chrom and start given
     """
+    # torch and orca are imported here, not at module level, so that --help
+    # and argument errors do not pay their startup time
+    import torch
+    import orca_predict
+
     orca_predict.load_resources(models=['1M'], use_cuda=use_cuda)
 
     encoded_sequence = orca_predict.hg38.get_encoding_from_coords(chrom, start, start + 1000000)[None, :, :]